@@ -0,0 +1,307 @@
+"""End-to-end load test of the API.
+
+Starts main:app (with its lifespan) behind httpx's ASGI transport, a monstr relay in this process and,
+unless --mongo-url is given, an in-memory stand-in for MongoDB. Seeds users, chats, members and messages,
+then drives a weighted mix of requests and prints throughput and latency percentiles per endpoint as JSON.
+
+    cd packages/rofl
+    python -m bench.loadtest --concurrency 32 --duration 30 --chats 20 --members 25 --out bench.json
+
+Everything shares one event loop, so the numbers are for comparing commits, not for sizing a deployment.
+"""
+import os
+import sys
+import time
+import json
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+import contextlib
+from collections import defaultdict
+from typing import Optional
+
+# request mix used when --mix isn't given, operation=weight
+DEFAULT_MIX = "message=40,feed=20,history=20,chats=5,join=5,user=5,chat=5"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        op, _, weight = part.partition("=")
+        if op.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {op}, expected one of {', '.join(OPERATIONS)}")
+        weights[op.strip()] = float(weight or 1)
+    return weights
+
+def percentile(latencies: list[float], p: float) -> float:
+    """latencies must be sorted, seconds in, milliseconds out."""
+    if not latencies:
+        return 0.0
+    return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2)
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadTest:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.users: list[str] = []
+        self.chats: list[str] = []
+        # chat id -> user ids in it, and the other way round
+        self.members: dict[str, set[str]] = defaultdict(set)
+        self.joined: dict[str, set[str]] = defaultdict(set)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        # requests that failed, and ones that got an answer saying the API refused them (error results)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.rejected: dict[str, int] = defaultdict(int)
+        self._counter = 0
+
+    def _new_id(self, prefix: str) -> str:
+        self._counter += 1
+        return f"{prefix}-{self.args.seed}-{self._counter}"
+
+    async def request(self, endpoint: str, method: str, url: str, record: bool = True,
+                      expect: Optional[str] = None, **kwargs):
+        """Sends a request, records its latency under endpoint and returns the json body (None on failure).
+        The API answers errors with status 200 too, as {"error": ...}, null or a result whose message isn't
+        the success one (which contains `expect`), those are counted as rejected and return None as well."""
+        started = time.perf_counter()
+        try:
+            res = await self.client.request(method, url, **kwargs)
+            ok = res.status_code == 200
+            body = res.json() if ok else None
+        except Exception as e:
+            logging.debug(f"{endpoint} {e}")
+            ok, body = False, None
+        rejected = ok and (body is None or "error" in body or
+                           (expect is not None and expect not in body.get("message", "")))
+        if rejected:
+            logging.debug(f"{endpoint} rejected {body}")
+        if record:
+            self.latencies[endpoint].append(time.perf_counter() - started)
+            if not ok:
+                self.errors[endpoint] += 1
+            elif rejected:
+                self.rejected[endpoint] += 1
+        return None if rejected else body
+
+    # the operations of the mix, each one request
+
+    async def op_user(self, record: bool = True):
+        uuid = self._new_id("user")
+        body = await self.request("POST /v1/user/new", "POST", "/v1/user/new", record,
+                                  expect="Created User ", json={"uuid": uuid, "display_name": uuid})
+        if body is not None:
+            self.users.append(uuid)
+
+    async def op_chat(self, record: bool = True):
+        creator = self.rnd.choice(self.users)
+        name = self._new_id("chat")
+        body = await self.request("POST /v1/create/", "POST", "/v1/create/", record, expect="Created new chat ",
+                                  json={"user_id": creator, "name": name, "description": name, "image_url": ""})
+        # the creator joins right away, the id is only in the message
+        if body is not None:
+            chat_id = body["message"].split()[3]
+            self.chats.append(chat_id)
+            self.members[chat_id].add(creator)
+            self.joined[creator].add(chat_id)
+
+    async def op_join(self, record: bool = True, user: Optional[str] = None, chat_id: Optional[str] = None):
+        user = user or self.rnd.choice(self.users)
+        chat_id = chat_id or self.rnd.choice(self.chats)
+        body = await self.request("POST /v1/join", "POST", "/v1/join", record, expect=" joined the chat ",
+                                  json={"chat_id": chat_id, "user_id": user})
+        if body is not None:
+            self.members[chat_id].add(user)
+            self.joined[user].add(chat_id)
+
+    async def op_message(self, record: bool = True, chat_id: Optional[str] = None):
+        chat_id = chat_id or self.rnd.choice(self.chats)
+        if not self.members[chat_id]:
+            return
+        user = self.rnd.choice(sorted(self.members[chat_id]))
+        # distinct text, the same message from the same user in the same second would be the same event
+        message = (self._new_id("message") + " ").ljust(self.args.message_size, "x")
+        await self.request("POST /v1/message", "POST", "/v1/message", record, expect="Managed to send ",
+                           json={"chat_id": chat_id, "user_id": user, "message": message})
+
+    async def op_feed(self, record: bool = True):
+        await self.request("GET /v1/chatfeedOf", "GET", f"/v1/chatfeedOf/{self.rnd.choice(self.users)}", record,
+                           expect="Chatfeed of ")
+
+    async def op_history(self, record: bool = True):
+        await self.request("GET /v1/historyOf", "GET", f"/v1/historyOf/{self.rnd.choice(self.chats)}", record)
+
+    async def op_chats(self, record: bool = True):
+        await self.request("GET /v1/chats", "GET", "/v1/chats", record)
+
+    async def op_search(self, record: bool = True):
+        # messages start with "message-<seed>-<counter> ", so a counter value matches at most one of them
+        await self.request("GET /v1/search", "GET", "/v1/search", record,
+                           params={"user": self.rnd.choice(self.users), "q": str(self.rnd.randint(1, self._counter))})
+
+    async def seed(self):
+        """Users, chats with --members members each and --messages messages each, not measured."""
+        args = self.args
+        for _ in range(args.users):
+            await self.op_user(record=False)
+        for _ in range(args.chats):
+            await self.op_chat(record=False)
+        for chat_id in self.chats:
+            for user in self.rnd.sample(self.users, min(args.members, len(self.users))):
+                if chat_id not in self.joined[user]:
+                    await self.op_join(record=False, user=user, chat_id=chat_id)
+        for chat_id in self.chats:
+            await asyncio.gather(*[self.op_message(record=False, chat_id=chat_id) for _ in range(args.messages)])
+
+    async def run(self, mix: dict[str, float]) -> float:
+        """Runs --concurrency workers for --duration seconds (or --requests in total), returns the elapsed time."""
+        ops = list(mix)
+        weights = [mix[op] for op in ops]
+        deadline = time.perf_counter() + self.args.duration
+        remaining = self.args.requests
+
+        async def worker():
+            nonlocal remaining
+            while time.perf_counter() < deadline:
+                if remaining is not None:
+                    if remaining <= 0:
+                        return
+                    remaining -= 1
+                op = self.rnd.choices(ops, weights)[0]
+                await getattr(self, f"op_{op}")()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(self.args.concurrency)])
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float, mix: dict[str, float]) -> dict:
+        endpoints = {}
+        total = 0
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            total += len(latencies)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "rejected": self.rejected[endpoint],
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                "p50_ms": percentile(latencies, 0.5),
+                "p95_ms": percentile(latencies, 0.95),
+                "p99_ms": percentile(latencies, 0.99),
+                "max_ms": round(latencies[-1] * 1000, 2)
+            }
+        return {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "config": {
+                "concurrency": self.args.concurrency,
+                "duration_s": self.args.duration,
+                "requests": self.args.requests,
+                "users": self.args.users,
+                "chats": self.args.chats,
+                "members": self.args.members,
+                "messages": self.args.messages,
+                "message_size": self.args.message_size,
+                "mix": mix,
+                "mongo": "mongodb" if self.args.mongo_url else "memory",
+                "seed": self.args.seed
+            },
+            "elapsed_s": round(elapsed, 3),
+            "total_requests": total,
+            "total_errors": sum(self.errors.values()),
+            "total_rejected": sum(self.rejected.values()),
+            "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "endpoints": endpoints
+        }
+
+
+OPERATIONS = [name[3:] for name in vars(LoadTest) if name.startswith("op_")]
+
+
+async def main(args) -> dict:
+    # the app's settings are read at import time, so they are set before importing it
+    relay_port = free_port()
+    os.environ["NOSTR_URL"] = f"ws://127.0.0.1:{relay_port}"
+    if args.mongo_url:
+        os.environ["MONGODB_URL"] = args.mongo_url
+        os.environ.setdefault("MONGODB_DATABASE", f"rofl_bench_{args.seed}")
+
+    import httpx
+    from relay.memory_store import ChatMemoryEventStore
+    from relay.chat_relay import ChatRelay
+    from v1.config import database
+    import main as api
+
+    if not args.mongo_url:
+        from bench.memory_mongo import MemoryMongoClient
+        database._client = MemoryMongoClient()
+
+    relay = ChatRelay(store=ChatMemoryEventStore())
+    await relay.start(host="127.0.0.1", port=relay_port, block=False)
+    try:
+        async with api.lifespan(api.app):
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as client:
+                test = LoadTest(client, args)
+                await test.seed()
+                # let the chat view catch up with the seeded events before measuring
+                await asyncio.sleep(1)
+                mix = parse_mix(args.mix)
+                elapsed = await test.run(mix)
+                return test.report(elapsed, mix)
+    finally:
+        await relay.end_background()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load test of the rofl API")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to run the mix for")
+    parser.add_argument("--requests", type=int, default=None, help="stop after this many requests instead")
+    parser.add_argument("--users", type=int, default=100, help="users created before the run")
+    parser.add_argument("--chats", type=int, default=10, help="chats created before the run")
+    parser.add_argument("--members", type=int, default=20, help="members joined to each chat before the run")
+    parser.add_argument("--messages", type=int, default=50, help="messages sent to each chat before the run")
+    parser.add_argument("--message-size", type=int, default=100, help="characters per message")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation=weight,... of {', '.join(OPERATIONS)}")
+    parser.add_argument("--mongo-url", default=None, help="benchmark against this MongoDB instead of the in-memory one")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, runs with the same seed send the same requests")
+    parser.add_argument("--out", default=None, help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    try:
+        parse_mix(args.mix)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # the app and the relay print as they go, keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(main(args))
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,160 @@
+import copy
+from collections import defaultdict
+from typing import Any, Optional
+
+
+class UpdateResult:
+    def __init__(self, matched_count: int = 0, modified_count: int = 0, upserted_id: Any = None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+def _get(doc: dict, path: str) -> Any:
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+def _parent(doc: dict, path: str) -> tuple[dict, str]:
+    parts = path.split(".")
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    return doc, parts[-1]
+
+def _equals(value: Any, expected: Any) -> bool:
+    # like MongoDB, a scalar matches an array that contains it
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+def matches(doc: dict, query: dict) -> bool:
+    for path, condition in query.items():
+        value = _get(doc, path)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, arg in condition.items():
+                if op == "$in":
+                    if not any(_equals(value, a) for a in arg):
+                        return False
+                elif op == "$ne":
+                    if _equals(value, arg):
+                        return False
+                else:
+                    raise NotImplementedError(f"memory_mongo: query operator {op}")
+        elif not _equals(value, condition):
+            return False
+    return True
+
+def apply_update(doc: dict, update: dict, inserting: bool = False) -> bool:
+    """Applies the update operators to doc, returns True if it changed."""
+    before = copy.deepcopy(doc)
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            parent, key = _parent(doc, path)
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                parent[key] = copy.deepcopy(arg)
+            elif op == "$setOnInsert":
+                continue
+            elif op == "$addToSet":
+                values = parent.setdefault(key, [])
+                if arg not in values:
+                    values.append(copy.deepcopy(arg))
+            elif op == "$unset":
+                parent.pop(key, None)
+            elif op == "$pull":
+                parent[key] = [v for v in parent.get(key, []) if v != arg]
+            elif op == "$inc":
+                parent[key] = parent.get(key, 0) + arg
+            elif op == "$max":
+                if key not in parent or parent[key] < arg:
+                    parent[key] = arg
+            else:
+                raise NotImplementedError(f"memory_mongo: update operator {op}")
+    return doc != before
+
+
+class MemoryCursor:
+    def __init__(self, docs: list[dict]):
+        self._docs = docs
+
+    def __aiter__(self):
+        self._it = iter(self._docs)
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length: Optional[int] = None) -> list[dict]:
+        return self._docs if length is None else self._docs[:length]
+
+
+class MemoryCollection:
+    """The part of motor's collection API the app uses, kept in a list with an index on uuid."""
+    def __init__(self):
+        self._docs: list[dict] = []
+        self._by_uuid: dict[Any, dict] = {}
+
+    def _candidates(self, query: dict) -> list[dict]:
+        # the users collection is always looked up by uuid, skip the scan for those
+        uuid = query.get("uuid")
+        if uuid is not None and not isinstance(uuid, dict):
+            doc = self._by_uuid.get(uuid)
+            return [doc] if doc is not None else []
+        return self._docs
+
+    async def find_one(self, query: dict, *args, **kwargs) -> Optional[dict]:
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                return copy.deepcopy(doc)
+        return None
+
+    def find(self, query: dict, *args, **kwargs) -> MemoryCursor:
+        return MemoryCursor([copy.deepcopy(doc) for doc in self._candidates(query) if matches(doc, query)])
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False) -> UpdateResult:
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                return UpdateResult(matched_count=1, modified_count=int(apply_update(doc, update)))
+        if not upsert:
+            return UpdateResult()
+        doc = {path: copy.deepcopy(value) for path, value in query.items() if not isinstance(value, dict)}
+        apply_update(doc, update, inserting=True)
+        self._docs.append(doc)
+        if "uuid" in doc:
+            self._by_uuid[doc["uuid"]] = doc
+        return UpdateResult(upserted_id=len(self._docs))
+
+    async def create_index(self, keys, **kwargs) -> str:
+        return "_".join(f"{name}_{direction}" for name, direction in keys)
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self._collections: dict[str, MemoryCollection] = defaultdict(MemoryCollection)
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._collections[name]
+
+    async def command(self, command: str, *args, **kwargs) -> dict:
+        return {"ok": 1.0}
+
+
+class MemoryMongoClient:
+    """Stands in for AsyncIOMotorClient when there is no MongoDB to benchmark against."""
+    def __init__(self):
+        self._databases: dict[str, MemoryDatabase] = defaultdict(MemoryDatabase)
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        return self._databases[name]
+
+    def close(self):
+        pass
@@ -1,8 +1,24 @@
+from contextlib import asynccontextmanager
+from typing import Optional, Union
 from pydantic import BaseModel
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from v1.processors.user import get_user, User
-from v1.processors.chat import get_chat, Chat, get_all_chats
+from v1.processors.user import get_user, send_message_batch, get_user_cache_stats, backfill_memberships, User
+from v1.processors.chat import get_chat, Chat, get_chat_directory, HISTORY_PAGE_SIZE, CHATS_PAGE_SIZE
+from v1.config.relay import get_relay, close_relay
+from v1.config.database import init_database, close_database
+from utils.signing import close_signing_executor
+from utils.metrics import (MetricsMiddleware, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+                           start_metrics_flush, stop_metrics_flush)
+from utils.profiling import check_admin_token, sample_profile, start_loop_monitor, stop_loop_monitor, get_loop_monitor
+from v1.models.responses import (ResultResponse, EmptyResult, ErrorResponse, StatusResponse, UserResponse,
+                                 MessageResponse, ChatResponse, ChatDirectoryResponse, SearchResponse,
+                                 FeedEntryResponse, ReadCursorResponse)
+from v1.processors.chat_view import start_chat_view, stop_chat_view
+from v1.processors.chat_stream import start_chat_broker, stop_chat_broker, get_chat_broker
+from v1.processors.cache_sync import start_cache_sync, stop_cache_sync, get_cache_sync
+from v1.processors.chat_search import start_chat_search, stop_chat_search, get_chat_search, SEARCH_PAGE_SIZE
 
 class NewUser(BaseModel):
     uuid: str
@@ -17,13 +33,52 @@ class NewMessage(BaseModel):
     user_id: str
     message: str
 
+class MessageBatch(BaseModel):
+    messages: list[NewMessage]
+
+class ReadCursor(BaseModel):
+    chat_id: str
+    user_id: str
+    # how many of the chat's messages have been read, all of them when left out
+    seq: Optional[int] = None
+
 class NewChat(BaseModel):
     user_id: str
     name: str
     description: str
     image_url: str
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # connect to MongoDB and make sure its indexes exist before the first request
+    await init_database()
+    # open the shared relay connections once, instead of on every request
+    await get_relay()
+    # keep chats in memory, fed by a subscription to the relay
+    await start_chat_view()
+    # full text index of all messages, fed by the chat view (so it is started right after it)
+    await start_chat_search()
+    # pushes new messages to /v1/stream clients
+    await start_chat_broker()
+    # with several workers, keeps their user caches in line with each other
+    await start_cache_sync()
+    # records event loop stalls and what was running during them, see /admin/loop
+    start_loop_monitor()
+    # with several workers, shares this worker's metrics with the others through METRICS_DIR
+    start_metrics_flush(collect_gauges)
+    yield
+    await stop_metrics_flush()
+    await stop_loop_monitor()
+    await stop_cache_sync()
+    await stop_chat_broker()
+    await stop_chat_search()
+    await stop_chat_view()
+    await close_relay()
+    await close_database()
+    close_signing_executor()
+
+# responses are validated against the models below and written with orjson
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,29 +87,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# outermost, so the time spent in the other middlewares is counted too
+app.add_middleware(MetricsMiddleware)
 
-@app.get("/")
+@app.get("/", response_model=StatusResponse)
 def idle():
     return {"status": "i'm alive"}
 
-@app.post("/v1/user/new")
+@app.post("/v1/user/new", response_model=ResultResponse[UserResponse])
 async def new_user(user: NewUser):
     res = await User.create(display_name=user.display_name, uuid=user.uuid)
     return res
 
-@app.post("/v1/join")
+@app.post("/v1/join", response_model=ResultResponse[list[str]])
 async def join_chat(params: ChatAction):
     user: "User" = await get_user(params.user_id)
     res = await user.join_chat(params.chat_id)
     return res
 
-@app.post("/v1/leave")
+@app.post("/v1/leave", response_model=ResultResponse[list[str]])
 async def leave_group(params: ChatAction):
     user: "User" = await get_user(params.user_id)
     res = await user.leave_chat(params.chat_id)
     return res
 
-@app.post("/v1/message")
+@app.post("/v1/message", response_model=Union[ResultResponse[MessageResponse], ErrorResponse])
 async def message(params: NewMessage):
     user: "User" = await get_user(params.user_id)
     if not user:
@@ -67,26 +124,119 @@ async def message(params: NewMessage):
     res = await chat.new_message(user, params.message)
     return res
 
-@app.post("/v1/create/")
+@app.post("/v1/messages/batch", response_model=ResultResponse[list[ResultResponse[MessageResponse]]])
+async def message_batch(params: MessageBatch):
+    """Sends many messages at once, the value holds the result of every message in order."""
+    res = await send_message_batch([(m.user_id, m.chat_id, m.message) for m in params.messages])
+    return res
+
+@app.post("/v1/create/", response_model=EmptyResult)
 async def create_chat(params: NewChat):
     user: "User" = await get_user(params.user_id)
     res = await user.create_chat(params.name, params.description, params.image_url)
     return res
 
-@app.get("/v1/chatfeedOf/{user}")
+@app.post("/v1/read", response_model=Union[ResultResponse[ReadCursorResponse], ErrorResponse])
+async def mark_read(params: ReadCursor):
+    """Marks a chat as read, up to `seq` messages or all of them."""
+    user: "User" = await get_user(params.user_id)
+    if not user:
+        return {"error": "User not found"}
+    res = await user.mark_read(params.chat_id, params.seq)
+    return res
+
+@app.get("/v1/chatfeedOf/{user}", response_model=ResultResponse[list[FeedEntryResponse]])
 async def get_chat_feed_of(user: str):
     user_inst: "User" = await get_user(user)
     res = await user_inst.get_chat_feed()
     return res
 
-@app.get("/v1/historyOf/{chat}")
-async def get_history_of(chat: str):
-    chat_inst: "Chat" = await get_chat(chat)
+@app.get("/v1/historyOf/{chat}", response_model=Optional[ChatResponse])
+async def get_history_of(chat: str, limit: int = HISTORY_PAGE_SIZE, before: Optional[str] = None, after: Optional[str] = None):
+    """Returns the chat with one page of messages, newest page first.
+    Pass `next_cursor` back as `before` for older messages, or as `after` when paging forward."""
+    chat_inst: "Chat" = await get_chat(chat, limit=limit, before=before, after=after)
     return chat_inst
 
-@app.get("/v1/chats")
-async def get_chats():
-    """Returns a list of all chat IDs that have been created."""
-    chat_ids = await get_all_chats()
-    return {"chats": chat_ids}
-
+@app.get("/v1/chats", response_model=ChatDirectoryResponse)
+async def get_chats(limit: int = CHATS_PAGE_SIZE, before: Optional[str] = None):
+    """Returns a page of chat summaries, most recently active first.
+    Pass `next_cursor` back as `before` for the next page."""
+    summaries, next_cursor = await get_chat_directory(limit=limit, before=before)
+    return {"chats": summaries, "next_cursor": next_cursor}
+
+@app.get("/v1/search", response_model=Union[SearchResponse, ErrorResponse])
+async def search(user: str, q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    """Messages of the chats the user is in that contain all words of `q`, best match first.
+    Pass `next_offset` back as `offset` for the next page."""
+    user_inst: "User" = await get_user(user)
+    if not user_inst:
+        return {"error": "User not found"}
+    chat_search = get_chat_search()
+    if not chat_search:
+        return {"error": "Search is not available"}
+    results, next_offset = await chat_search.search(user_inst.joined_chats, q, limit=limit, offset=offset)
+    return {"results": results, "next_offset": next_offset}
+
+@app.get("/v1/stream")
+async def stream_messages(chats: str, last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")):
+    """Server-sent events with every new message of the given chats (comma separated ids).
+    Each event's id is a history cursor, so missed messages can be fetched with `after`."""
+    broker = get_chat_broker()
+    if not broker:
+        return {"error": "Streaming is not available"}
+    channel_ids = [chat_id for chat_id in chats.split(",") if chat_id]
+    return StreamingResponse(broker.stream(channel_ids, last_event_id),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics: request, processor, MongoDB, relay and signing latencies, plus cache and publish state.
+    With several workers they are only complete with METRICS_DIR set, see utils/metrics.py."""
+    return Response(render_metrics(await collect_gauges()), media_type=METRICS_CONTENT_TYPE)
+
+async def collect_gauges() -> dict[str, float]:
+    """The point-in-time state of this worker."""
+    gauges = {f"rofl_user_cache_{name}": value for name, value in get_user_cache_stats().items()}
+    relay = await get_relay()
+    gauges.update({f"rofl_relay_{name}": value for name, value in relay.stats().items()})
+    broker = get_chat_broker()
+    if broker:
+        gauges["rofl_stream_clients"] = broker.clients
+    chat_search = get_chat_search()
+    if chat_search:
+        gauges["rofl_search_indexed"] = chat_search.indexed
+        gauges["rofl_search_pending"] = chat_search.pending
+        gauges["rofl_search_catching_up"] = int(chat_search.catching_up)
+        gauges["rofl_search_writing"] = int(chat_search.writing)
+    cache_sync = get_cache_sync()
+    if cache_sync:
+        gauges.update({f"rofl_{name}": value for name, value in cache_sync.stats().items()})
+    return gauges
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not check_admin_token(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profile", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def profile(seconds: float = 10, interval_ms: float = Query(5, gt=0)):
+    """Samples the stacks of this worker for a while and returns them folded, ready for flamegraph.pl or speedscope."""
+    stacks = await sample_profile(seconds, interval_ms / 1000)
+    if stacks is None:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    return PlainTextResponse(stacks)
+
+@app.post("/admin/memberships/backfill", response_model=EmptyResult, include_in_schema=False,
+          dependencies=[Depends(require_admin)])
+async def memberships_backfill():
+    """Publishes the join events of users who joined chats before members were tracked on the relay, run once."""
+    return await backfill_memberships()
+
+@app.get("/admin/loop", include_in_schema=False, dependencies=[Depends(require_admin)])
+async def loop_lag():
+    """Event loop lag of this worker and the latest stalls, each with the stack that was running."""
+    monitor = get_loop_monitor()
+    if not monitor:
+        return {"error": "The event loop monitor is off"}
+    return monitor.stats()
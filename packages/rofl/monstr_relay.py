@@ -1,10 +1,23 @@
+import os
 import asyncio
 import logging
-from monstr.relay.relay import Relay
-from monstr.event.persist_memory import RelayMemoryEventStore
+from relay.memory_store import ChatMemoryEventStore
+from relay.sqlite_store import SQLiteEventStore
+from relay.chat_relay import ChatRelay
+
+# "sqlite" keeps events on the persistent volume, "memory" loses them on restart
+RELAY_STORE = os.getenv("RELAY_STORE", "sqlite")
+RELAY_DB_PATH = os.getenv("RELAY_DB_PATH", "/data/relay.db")
 
 async def run_relay():
-    r = Relay(store=RelayMemoryEventStore())
+    if RELAY_STORE == "memory":
+        store = ChatMemoryEventStore()
+    else:
+        store = SQLiteEventStore(RELAY_DB_PATH)
+        await store.open()
+
+    # verifies signatures in the signing executor (SIGNING_EXECUTOR / SIGNING_WORKERS)
+    r = ChatRelay(store=store)
     await r.start(host="0.0.0.0", port=8082)
 
 if __name__ == '__main__':
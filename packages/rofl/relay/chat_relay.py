@@ -0,0 +1,59 @@
+import logging
+import asyncio
+from monstr.event.event import Event
+from monstr.event.persist import ARelayEventStoreInterface
+from monstr.relay.relay import Relay
+from monstr.relay.exceptions import NostrCommandException, NostrNoticeException
+from utils.signing import verify_event
+from utils.nostr import matches
+
+
+class ChatRelay(Relay):
+    """monstr's Relay, but incoming signatures are verified in the signing executor
+    instead of on the event loop that serves every websocket, and new events are matched
+    against subscriptions with since/until inclusive, the same as the stores answer them."""
+
+    async def _do_event(self, req_json, ws):
+        # same steps as Relay._do_event (monstr 0.1.9), only the is_valid call is moved off the loop
+        if len(req_json) <= 1:
+            raise NostrNoticeException('EVENT command missing event data')
+
+        evt = Event.load(req_json[1])
+        # check event sig matches pub_key
+        if not await verify_event(evt):
+            raise NostrCommandException(event_id=evt.id,
+                                        success=False,
+                                        message='invalid: signature validation failed')
+
+        # acceptors may throw NostrCommandException, NostrNoticeException, NostrNotAuthenticatedException
+        for c_accept in self._accept_req:
+            c_accept.accept_post(ws, evt)
+
+        saved = False
+        try:
+            if self._store:
+                if isinstance(self._store, ARelayEventStoreInterface):
+                    await self._store.add_event(evt)
+                else:
+                    self._store.add_event(evt)
+                saved = True
+        except Exception as e:
+            logging.debug('ChatRelay::store event failed - %s' % e)
+
+        await self._check_subs(evt)
+
+        raise NostrCommandException(event_id=evt.id,
+                                    success=saved,
+                                    message='')
+
+    async def _check_subs(self, evt: Event):
+        # same as Relay._check_subs (monstr 0.1.9), only the filter test is inclusive
+        tasks = set()
+        for socket_id in self._ws:
+            for c_sub_id in self._ws[socket_id]['subs']:
+                the_sub = self._ws[socket_id]['subs'][c_sub_id]
+                filters = the_sub['filter'] if isinstance(the_sub['filter'], list) else [the_sub['filter']]
+                if any(matches(evt, c_filter) for c_filter in filters):
+                    n_task = asyncio.create_task(self._send_event(self._ws[socket_id]['ws'], the_sub, evt.data()))
+                    tasks.add(n_task)
+                    n_task.add_done_callback(tasks.discard)
@@ -0,0 +1,257 @@
+import os
+import time
+import bisect
+import logging
+from typing import Optional
+from collections import OrderedDict
+from monstr.event.event import Event
+from monstr.event.persist import DeleteMode
+from monstr.event.persist_memory import RelayMemoryEventStore
+from utils.nostr import channel_of, matches, INDEXED_TAG_LEN
+
+# Retention of channel messages (kind 42), kind 40 channel-create events are never evicted
+# newest messages kept per channel, older ones fall out like a ring buffer
+RELAY_MAX_CHANNEL_MESSAGES = int(os.getenv("RELAY_MAX_CHANNEL_MESSAGES", "10000"))
+# rough budget for all stored events, the least recently used channels lose their messages first
+RELAY_MAX_BYTES = int(os.getenv("RELAY_MAX_BYTES", str(1024 * 1024 * 1024)))
+# messages older than this many seconds are dropped, 0 keeps them forever
+RELAY_MAX_AGE = int(os.getenv("RELAY_MAX_AGE", "0"))
+
+# approximate size of an event besides its content and tags (id, pubkey, sig and the objects)
+EVENT_OVERHEAD = 600
+# how often (seconds) expired messages are looked for
+EXPIRE_INTERVAL = 60
+
+
+def event_size(evt: Event) -> int:
+    return EVENT_OVERHEAD + len(evt.content) + sum(len(value) for tag in evt.tags for value in tag)
+
+def index_keys(evt: Event) -> set[tuple]:
+    """The (kind, tag name, tag value) index entries of an event."""
+    return {(evt.kind, tag[0], tag[1]) for tag in evt.tags if len(tag) > 1 and len(tag[0]) == INDEXED_TAG_LEN}
+
+
+class ChatMemoryEventStore(RelayMemoryEventStore):
+    """In memory relay store with retention, so it fits in the memory given to the ROFL container.
+
+    Events are indexed by kind and by (kind, tag name, tag value), each index a list of
+    (created_at, id) kept sorted, so a `{"kinds": [42], "#e": [channel]}` query only looks
+    at that channel's events instead of everything stored.
+
+    It also applies `limit` to each filter, as NIP-01 asks for, instead of once over the union
+    of all filters. This is what lets the API ask for the newest message of many channels in a
+    single REQ. since/until are inclusive, the same as in the SQLite store.
+    """
+
+    def __init__(self,
+                 max_channel_messages: int = RELAY_MAX_CHANNEL_MESSAGES,
+                 max_bytes: int = RELAY_MAX_BYTES,
+                 max_age: int = RELAY_MAX_AGE,
+                 **kargs):
+        super().__init__(**kargs)
+        self._max_channel_messages = max_channel_messages
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+
+        # kind -> [(created_at, id)] and (kind, tag name, tag value) -> [(created_at, id)], oldest first
+        self._kind_index: dict[int, list[tuple[int, str]]] = {}
+        self._tag_index: dict[tuple, list[tuple[int, str]]] = {}
+        # channels with messages, ordered from least to most recently used
+        self._channels: OrderedDict[str, None] = OrderedDict()
+        # event id -> estimated size
+        self._sizes: dict[str, int] = {}
+        self._bytes = 0
+        self._last_expire = time.time()
+
+    def add_event(self, evt: Event):
+        if isinstance(evt, Event):
+            evt = [evt]
+        for c_evt in evt:
+            # already have it, don't index it twice
+            if c_evt.id in self._events:
+                continue
+
+            # replaceable events remove the version they replace
+            replaced = self._replaced_by(c_evt)
+            super().add_event(c_evt)
+            if replaced is not None and replaced.id not in self._events:
+                self._unindex(replaced)
+
+            if c_evt.id not in self._events:
+                continue
+            self._index(c_evt)
+
+            if c_evt.kind == Event.KIND_CHANNEL_MESSAGE:
+                channel_id = channel_of(c_evt)
+                if channel_id is not None:
+                    self._add_to_channel(channel_id)
+
+        self._enforce_budget()
+        if self._max_age and time.time() - self._last_expire >= EXPIRE_INTERVAL:
+            self.expire()
+
+    def _replaced_by(self, evt: Event) -> Optional[Event]:
+        if self.is_replaceable(evt):
+            return self._replaceables.get(f'{evt.pub_key}:{evt.kind}')
+        if self.is_parameter_replaceable(evt):
+            return self._para_replaceables.get(f'{evt.pub_key}:{evt.kind}:{evt.get_tag_value_pos("d", default="")}')
+        return None
+
+    def do_delete(self, evt: Event):
+        # in delete mode the event data is dropped, only the deleted flag stays
+        if self._delete_mode == DeleteMode.delete:
+            for c_id in evt.e_tags:
+                r = self._events.get(c_id)
+                if r is not None and 'evt' in r:
+                    self._unindex(r['evt'])
+        super().do_delete(evt)
+
+    @staticmethod
+    def _insert(index: dict, key, entry: tuple[int, str]):
+        entries = index.get(key)
+        if entries is None:
+            index[key] = [entry]
+        elif entry >= entries[-1]:
+            # events mostly arrive in order, so this is nearly always an append
+            entries.append(entry)
+        else:
+            bisect.insort(entries, entry)
+
+    @staticmethod
+    def _remove(index: dict, key, entry: tuple[int, str]):
+        entries = index.get(key)
+        if entries is None:
+            return
+        pos = bisect.bisect_left(entries, entry)
+        if pos < len(entries) and entries[pos] == entry:
+            del entries[pos]
+        if not entries:
+            del index[key]
+
+    def _index(self, evt: Event):
+        entry = (evt.created_at_ticks, evt.id)
+        self._insert(self._kind_index, evt.kind, entry)
+        for key in index_keys(evt):
+            self._insert(self._tag_index, key, entry)
+        self._sizes[evt.id] = event_size(evt)
+        self._bytes += self._sizes[evt.id]
+
+    def _unindex(self, evt: Event):
+        entry = (evt.created_at_ticks, evt.id)
+        self._remove(self._kind_index, evt.kind, entry)
+        for key in index_keys(evt):
+            self._remove(self._tag_index, key, entry)
+        self._bytes -= self._sizes.pop(evt.id, 0)
+
+    def _forget(self, event_id: str):
+        r = self._events.pop(event_id, None)
+        if r is not None and 'evt' in r:
+            self._unindex(r['evt'])
+
+    def _channel_messages(self, channel_id: str) -> list[tuple[int, str]]:
+        return self._tag_index.get((Event.KIND_CHANNEL_MESSAGE, "e", channel_id), [])
+
+    def _add_to_channel(self, channel_id: str):
+        self._channels[channel_id] = None
+        self._channels.move_to_end(channel_id)
+        messages = self._channel_messages(channel_id)
+        while len(messages) > self._max_channel_messages:
+            self._forget(messages[0][1])
+
+    def _touch(self, filters):
+        """Marks the channels asked for in #e filters as recently used."""
+        for c_filter in filters:
+            for channel_id in c_filter.get("#e", []):
+                if channel_id in self._channels:
+                    self._channels.move_to_end(channel_id)
+
+    def _enforce_budget(self):
+        evicted = 0
+        while self._bytes > self._max_bytes and self._channels:
+            channel_id = next(iter(self._channels))
+            messages = self._channel_messages(channel_id)
+            if len(self._channels) == 1:
+                # only one channel left, trim it from the oldest message instead
+                if not messages:
+                    del self._channels[channel_id]
+                    break
+                self._forget(messages[0][1])
+                evicted += 1
+                continue
+            while messages:
+                self._forget(messages[0][1])
+                evicted += 1
+            del self._channels[channel_id]
+        if evicted:
+            logging.info(f"ChatMemoryEventStore::_enforce_budget evicted {evicted} messages, {self._bytes} bytes in use")
+
+    def expire(self):
+        """Drops channel messages older than max_age."""
+        self._last_expire = time.time()
+        if not self._max_age:
+            return
+        oldest_allowed = self._last_expire - self._max_age
+        for channel_id in list(self._channels):
+            messages = self._channel_messages(channel_id)
+            while messages and messages[0][0] < oldest_allowed:
+                self._forget(messages[0][1])
+            if not messages:
+                del self._channels[channel_id]
+
+    def _candidates(self, the_filter: dict) -> Optional[list[list[tuple[int, str]]]]:
+        """The index lists that hold every event the filter can match, None if no index fits."""
+        kinds = the_filter.get("kinds")
+        if kinds is not None and not isinstance(kinds, list):
+            kinds = [kinds]
+        tag_filters = [(name[1:], values if isinstance(values, list) else [values])
+                       for name, values in the_filter.items() if name.startswith("#")]
+
+        if kinds and tag_filters:
+            # the first tag condition picks the lists, the rest is checked per event
+            name, values = tag_filters[0]
+            return [self._tag_index.get((kind, name, str(value)), []) for kind in kinds for value in values]
+        if kinds:
+            return [self._kind_index.get(kind, []) for kind in kinds]
+        return None
+
+    def _query(self, the_filter: dict) -> list[dict]:
+        candidates = self._candidates(the_filter)
+        if candidates is None:
+            # no index fits, every stored event is a candidate
+            candidates = [sorted((r['evt'].created_at_ticks, event_id) for event_id, r in self._events.items()
+                                 if not r['is_deleted'])]
+
+        # since/until narrow the range, the rest of the filter is checked per event
+        low = (the_filter["since"], "") if "since" in the_filter else None
+        high = (the_filter["until"] + 1, "") if "until" in the_filter else None
+        entries = []
+        for c_list in candidates:
+            start = bisect.bisect_left(c_list, low) if low else 0
+            end = bisect.bisect_left(c_list, high) if high else len(c_list)
+            entries.extend(c_list[start:end])
+        entries.sort(reverse=True)
+
+        limit = the_filter.get("limit")
+        ret = {}
+        for created_at, event_id in entries:
+            if limit is not None and len(ret) >= limit:
+                break
+            r = self._events.get(event_id)
+            if r is None or r['is_deleted'] or event_id in ret:
+                continue
+            if matches(r['evt'], the_filter):
+                ret[event_id] = r['evt'].data()
+        return list(ret.values())
+
+    def get_filter(self, filters):
+        if isinstance(filters, dict):
+            filters = [filters]
+        self._touch(filters)
+
+        ret = {}
+        for c_filter in filters:
+            for evt in self._query(c_filter):
+                ret[evt['id']] = evt
+
+        # newest first, same as the default sort direction of the store
+        return sorted(ret.values(), key=lambda evt: evt['created_at'], reverse=True)
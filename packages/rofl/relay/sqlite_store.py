@@ -0,0 +1,205 @@
+import os
+import json
+import logging
+from typing import Optional
+import aiosqlite
+from monstr.event.event import Event
+from monstr.event.persist import ARelayEventStoreInterface, StoreNIPSupport, DeleteMode
+from utils.nostr import INDEXED_TAG_LEN
+
+CREATE_SQL = [
+    """
+    create table if not exists events(
+        id text primary key,
+        pubkey text not null,
+        created_at integer not null,
+        kind integer not null,
+        tags text not null,
+        content text not null,
+        sig text not null,
+        deleted integer not null default 0
+    )
+    """,
+    "create index if not exists events_kind_created on events(kind, created_at)",
+    "create index if not exists events_pubkey_created on events(pubkey, created_at)",
+    "create index if not exists events_created on events(created_at)",
+    # one row per tag, kind and created_at are copied in so #e + kind + time range is a single index range
+    """
+    create table if not exists event_tags(
+        event_id text not null references events(id) on delete cascade,
+        name text not null,
+        value text not null,
+        kind integer not null,
+        created_at integer not null
+    )
+    """,
+    "create index if not exists event_tags_lookup on event_tags(name, value, kind, created_at)",
+    "create index if not exists event_tags_event on event_tags(event_id)",
+]
+
+
+class SQLiteEventStore(ARelayEventStoreInterface):
+    """Disk backed relay store, memory use stays flat however many events it holds.
+    Like ChatMemoryEventStore it applies `limit` to each filter on its own.
+    """
+
+    def __init__(self, db_file: str, delete_mode=DeleteMode.flag, is_nip16=True, is_nip33=True):
+        StoreNIPSupport.__init__(self,
+                                 delete_mode=delete_mode,
+                                 nip16=is_nip16,
+                                 nip33=is_nip33)
+        self._db_file = db_file
+        self._db: Optional[aiosqlite.Connection] = None
+
+    async def open(self):
+        if self._db_file != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self._db_file)), exist_ok=True)
+        self._db = await aiosqlite.connect(self._db_file)
+        self._db.row_factory = aiosqlite.Row
+        await self._db.execute("pragma journal_mode=wal")
+        await self._db.execute("pragma synchronous=normal")
+        await self._db.execute("pragma foreign_keys=on")
+        for sql in CREATE_SQL:
+            await self._db.execute(sql)
+        await self._db.commit()
+        logging.info(f"SQLiteEventStore::open {self._db_file}")
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def add_event(self, evt: Event):
+        if self.is_ephemeral(evt):
+            return
+
+        cursor = await self._db.execute(
+            "insert or ignore into events(id, pubkey, created_at, kind, tags, content, sig) values(?,?,?,?,?,?,?)",
+            (evt.id, evt.pub_key, evt.created_at_ticks, evt.kind, json.dumps(evt.tags.tags), evt.content, evt.sig))
+        # already stored, nothing else to do
+        if cursor.rowcount == 0:
+            await self._db.commit()
+            return
+
+        await self._db.executemany(
+            "insert into event_tags(event_id, name, value, kind, created_at) values(?,?,?,?,?)",
+            [(evt.id, name, value, evt.kind, evt.created_at_ticks)
+             for name, value in {(tag[0], tag[1]) for tag in evt.tags if len(tag) > 1 and len(tag[0]) == INDEXED_TAG_LEN}])
+
+        # NIP-16/33 only the newest version of a replaceable event is kept
+        if self.is_replaceable(evt):
+            await self._db.execute(
+                """delete from events where kind=? and pubkey=?
+                   and id not in (select id from events where kind=? and pubkey=? order by created_at desc limit 1)""",
+                (evt.kind, evt.pub_key, evt.kind, evt.pub_key))
+        elif self.is_parameter_replaceable(evt):
+            d_tag = evt.get_tag_value_pos("d", default="")
+            await self._db.execute(
+                """delete from events where id in (
+                       select event_id from event_tags where name='d' and value=? and kind=?)
+                   and pubkey=? and id not in (
+                       select e.id from events e join event_tags t on t.event_id=e.id
+                       where t.name='d' and t.value=? and e.kind=? and e.pubkey=?
+                       order by e.created_at desc limit 1)""",
+                (d_tag, evt.kind, evt.pub_key, d_tag, evt.kind, evt.pub_key))
+
+        if evt.kind == Event.KIND_DELETE:
+            await self._delete(evt)
+
+        await self._db.commit()
+
+    async def do_delete(self, evt: Event):
+        await self._delete(evt)
+        await self._db.commit()
+
+    async def _delete(self, evt: Event):
+        # NIP-09 authors can only delete their own events
+        to_delete = evt.e_tags
+        if self.delete_mode == DeleteMode.no_action or not to_delete:
+            return
+        args = to_delete + [evt.pub_key, Event.KIND_DELETE]
+        marks = ",".join("?" * len(to_delete))
+        if self.delete_mode == DeleteMode.flag:
+            await self._db.execute(f"update events set deleted=1 where id in ({marks}) and pubkey=? and kind<>?", args)
+        else:
+            await self._db.execute(f"delete from events where id in ({marks}) and pubkey=? and kind<>?", args)
+
+    @staticmethod
+    def _prefix_or_exact(column: str, values: list[str], where: list[str], args: list):
+        # full length ids/pubkeys are exact index lookups, shorter ones are treated as prefixes
+        exact = [v for v in values if len(v) == 64]
+        prefixes = [v for v in values if len(v) != 64]
+        ors = []
+        if exact:
+            ors.append(f"{column} in ({','.join('?' * len(exact))})")
+            args.extend(exact)
+        for prefix in prefixes:
+            ors.append(f"({column} >= ? and {column} < ?)")
+            args.extend([prefix, prefix + "￿"])
+        where.append("(" + " or ".join(ors) + ")" if ors else "0")
+
+    def _filter_sql(self, the_filter: dict) -> tuple[str, list]:
+        where = ["e.deleted=0"]
+        args: list = []
+        tag_filters = [(name[1:], values if isinstance(values, list) else [str(values)])
+                       for name, values in the_filter.items() if name.startswith("#")]
+
+        # the first tag condition drives the query through the event_tags index
+        if tag_filters:
+            name, values = tag_filters[0]
+            # an event can only match twice when asking for several values
+            distinct = "distinct " if len(values) > 1 else ""
+            sql = f"select {distinct}e.* from event_tags t join events e on e.id=t.event_id"
+            where.append(f"t.name=? and t.value in ({','.join('?' * len(values))})")
+            args.extend([name] + values)
+            prefix = "t"
+        else:
+            sql = "select e.* from events e"
+            prefix = "e"
+
+        kinds = the_filter.get("kinds")
+        if kinds:
+            kinds = kinds if isinstance(kinds, list) else [kinds]
+            where.append(f"{prefix}.kind in ({','.join('?' * len(kinds))})")
+            args.extend(kinds)
+        if "since" in the_filter:
+            where.append(f"{prefix}.created_at>=?")
+            args.append(the_filter["since"])
+        if "until" in the_filter:
+            where.append(f"{prefix}.created_at<=?")
+            args.append(the_filter["until"])
+        if the_filter.get("ids") is not None:
+            self._prefix_or_exact("e.id", the_filter["ids"], where, args)
+        if the_filter.get("authors") is not None:
+            self._prefix_or_exact("e.pubkey", the_filter["authors"], where, args)
+
+        for name, values in tag_filters[1:]:
+            where.append(f"e.id in (select event_id from event_tags where name=? and value in ({','.join('?' * len(values))}))")
+            args.extend([name] + values)
+
+        sql += " where " + " and ".join(where) + f" order by {prefix}.created_at desc"
+        if "limit" in the_filter:
+            sql += " limit ?"
+            args.append(int(the_filter["limit"]))
+        return sql, args
+
+    async def get_filter(self, filters) -> list[dict]:
+        if isinstance(filters, dict):
+            filters = [filters]
+
+        ret = {}
+        for the_filter in filters:
+            sql, args = self._filter_sql(the_filter)
+            async with self._db.execute(sql, args) as cursor:
+                async for row in cursor:
+                    ret[row["id"]] = {
+                        "id": row["id"],
+                        "pubkey": row["pubkey"],
+                        "created_at": row["created_at"],
+                        "kind": row["kind"],
+                        "tags": json.loads(row["tags"]),
+                        "content": row["content"],
+                        "sig": row["sig"]
+                    }
+
+        return sorted(ret.values(), key=lambda evt: evt["created_at"], reverse=True)
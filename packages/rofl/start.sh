@@ -1,7 +1,16 @@
 #!/bin/sh
 
+# One API worker per CPU of the ROFL machine (resources.cpus in rofl.yaml) unless API_WORKERS is set,
+# the workers keep their caches in line through the relay (v1/processors/cache_sync.py)
+export API_WORKERS="${API_WORKERS:-$(nproc)}"
+
+# The workers share their metrics through this directory so /metrics covers all of them (utils/metrics.py),
+# what is left from the last run is cleared first
+export METRICS_DIR="${METRICS_DIR:-/tmp/rofl-metrics}"
+rm -rf "$METRICS_DIR" && mkdir -p "$METRICS_DIR"
+
 # Start the FastAPI app in the background
-uvicorn main:app --host 0.0.0.0 --port 8080 &
+uvicorn main:app --host 0.0.0.0 --port 8080 --workers "$API_WORKERS" &
 
 # Start the Monstr relay
 python monstr_relay.py
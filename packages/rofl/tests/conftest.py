@@ -0,0 +1,63 @@
+import asyncio
+import pytest
+from monstr.event.event import Event
+from monstr.encrypt import Keys
+from relay.memory_store import ChatMemoryEventStore
+from relay.sqlite_store import SQLiteEventStore
+
+CHANNEL_ID = "c" * 64
+KEYS = Keys()
+
+
+class StoreRelay:
+    """Answers RelayPool.query straight from a relay store, without a websocket in between."""
+    def __init__(self, store):
+        self.store = store
+        self.queries: list[list[dict]] = []
+
+    async def query(self, filters, timeout: float = 0) -> list[Event]:
+        if isinstance(filters, dict):
+            filters = [filters]
+        self.queries.append(filters)
+        if isinstance(self.store, SQLiteEventStore):
+            evts = await self.store.get_filter(filters)
+        else:
+            evts = self.store.get_filter(filters)
+        return [Event.load(evt) for evt in evts]
+
+
+def messages(created_ats: list[int], channel_id: str = CHANNEL_ID) -> list[Event]:
+    """Signed kind-42 messages of a channel, one per created_at."""
+    ret = []
+    for i, created_at in enumerate(created_ats):
+        evt = Event(kind=Event.KIND_CHANNEL_MESSAGE, content=f"m{i}", pub_key=KEYS.public_key_hex(),
+                    tags=[["e", channel_id, "", "root"]], created_at=created_at)
+        evt.sign(KEYS.private_key_hex())
+        ret.append(evt)
+    return ret
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store_relay(request):
+    """A StoreRelay over each of the relay stores, call it with the events to store."""
+    stores = []
+
+    def make(evts: list[Event]) -> StoreRelay:
+        if request.param == "memory":
+            store = ChatMemoryEventStore()
+            store.add_event(evts)
+        else:
+            store = SQLiteEventStore(":memory:")
+
+            async def fill():
+                await store.open()
+                for evt in evts:
+                    await store.add_event(evt)
+            asyncio.run(fill())
+        stores.append(store)
+        return StoreRelay(store)
+
+    yield make
+    for store in stores:
+        if isinstance(store, SQLiteEventStore):
+            asyncio.run(store.close())
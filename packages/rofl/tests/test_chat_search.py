@@ -0,0 +1,54 @@
+import asyncio
+from v1.processors import chat_search
+from conftest import CHANNEL_ID, messages
+
+NOW = 1_700_000_000
+
+
+def test_walk_back_indexes_crowded_seconds(store_relay, monkeypatch):
+    """More messages than a batch in a single second are all indexed, and the walk ends."""
+    created_ats = [NOW - 10 + i for i in range(10)] + [NOW] * 600 + [NOW + 1 + i // 200 for i in range(400)]
+    relay = store_relay(messages(created_ats))
+
+    async def get_relay():
+        return relay
+    monkeypatch.setattr(chat_search, "get_relay", get_relay)
+
+    async def run():
+        search = chat_search.ChatSearch(":memory:")
+        await search.start()
+        try:
+            await asyncio.wait_for(search._catch_up, 10)
+            cursor = await search._db.execute("select count(*) from messages")
+            return (await cursor.fetchone())[0]
+        finally:
+            await search.stop()
+    assert asyncio.run(run()) == len(created_ats)
+
+
+def test_one_writer_per_file(store_relay, monkeypatch, tmp_path):
+    """Of two instances on one file only one writes, the other takes over once it stops."""
+    relay = store_relay(messages([NOW + i for i in range(20)]))
+
+    async def get_relay():
+        return relay
+    monkeypatch.setattr(chat_search, "get_relay", get_relay)
+    monkeypatch.setattr(chat_search, "SEARCH_LOCK_RETRY", 0.01)
+
+    async def run():
+        db_path = str(tmp_path / "search.db")
+        first, second = chat_search.ChatSearch(db_path), chat_search.ChatSearch(db_path)
+        await first.start()
+        await second.start()
+        try:
+            assert (first.writing, second.writing) == (True, False)
+            await first._catch_up
+            results, _ = await second.search([CHANNEL_ID], "m7")
+            assert [result["message"] for result in results] == ["m7"]
+            await first.stop()
+            await asyncio.wait_for(second._waiting, 1)
+            assert second.writing
+        finally:
+            await first.stop()
+            await second.stop()
+    asyncio.run(run())
@@ -0,0 +1,21 @@
+import asyncio
+import pytest
+from v1.processors import chat_view
+from v1.processors.chat_view import ChatView
+from conftest import CHANNEL_ID, messages
+
+NOW = 1_700_000_000
+
+
+@pytest.mark.parametrize("created_ats", [
+    [NOW + i for i in range(37)],
+    [NOW + i // 4 for i in range(37)],
+    [NOW] * 37,
+    [NOW + i for i in range(10)],
+    [],
+], ids=["spread", "crowded", "one second", "exactly a batch", "empty"])
+def test_count_messages(store_relay, monkeypatch, created_ats):
+    """Counting a chat's history walks it in batches and counts every message once."""
+    monkeypatch.setattr(chat_view, "CHAT_VIEW_COUNT_BATCH", 10)
+    relay = store_relay(messages(created_ats) + messages([NOW] * 5, channel_id="d" * 64))
+    assert asyncio.run(ChatView._count_messages(relay, CHANNEL_ID)) == len(created_ats)
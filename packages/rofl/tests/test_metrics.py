@@ -0,0 +1,39 @@
+import os
+import json
+from utils import metrics
+from utils.metrics import Counter, Histogram
+
+REQUESTS = Counter("test_requests_total", "Requests of the test", ("route",))
+LATENCY = Histogram("test_latency_seconds", "Latency of the test", buckets=(0.1, 1.0))
+
+
+def other_worker(pid: int, requests: float, latency: list, gauges: dict) -> dict:
+    return {"metrics": {"test_requests_total": [[["/a"], requests]], "test_latency_seconds": [[[], latency]]},
+            "gauges": gauges}
+
+
+def test_workers_are_summed(monkeypatch, tmp_path):
+    """Counters and histograms add up over all workers, gauges are given per running worker."""
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    REQUESTS.inc(route="/a")
+    LATENCY.observe(0.05)
+    # a running worker and one that is gone
+    gone = 2 ** 22 + 1
+    for pid, requests in ((os.getppid(), 2), (gone, 4)):
+        with open(tmp_path / f"{pid}.json", "w") as f:
+            json.dump(other_worker(pid, requests, [[0, 1, 0], 0.5], {"test_clients": requests}), f)
+
+    metrics.write_snapshot({"test_clients": 1})
+    assert os.path.exists(tmp_path / f"{os.getpid()}.json")
+    lines = metrics.render({"test_clients": 1}).splitlines()
+    assert 'test_requests_total{route="/a"} 7' in lines
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="1"} 3' in lines
+    assert "test_latency_seconds_count 3" in lines
+    assert [line for line in lines if line.startswith("test_clients")] == [
+        f'test_clients{{worker="{os.getpid()}"}} 1', f'test_clients{{worker="{os.getppid()}"}} 2']
+
+
+def test_single_worker(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", "")
+    assert "test_clients 1" in metrics.render({"test_clients": 1}).splitlines()
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from utils.nostr import event_key
+from utils.cursor import encode_cursor
+from v1.processors import chat
+from conftest import CHANNEL_ID, StoreRelay, messages
+
+NOW = 1_700_000_000
+
+
+@pytest.fixture
+def walk(store_relay, monkeypatch):
+    """Stores messages at the given times and returns every page of the channel, walking forward or back."""
+    def run(created_ats: list[int], limit: int, forward: bool) -> tuple[list[list], list, StoreRelay]:
+        evts = messages(created_ats)
+        relay = store_relay(evts)
+
+        async def get_relay():
+            return relay
+        monkeypatch.setattr(chat, "get_relay", get_relay)
+        monkeypatch.setattr(chat.time, "time", lambda: NOW + 4 * chat.HISTORY_WINDOW)
+
+        async def pages():
+            ret = []
+            # forward walks start from a cursor before the first message
+            cursor = encode_cursor(NOW - 1, "") if forward else None
+            while True:
+                if forward:
+                    page, cursor = await chat.get_message_page(CHANNEL_ID, limit, after=cursor)
+                else:
+                    page, cursor = await chat.get_message_page(CHANNEL_ID, limit, before=cursor)
+                ret.append(page)
+                if cursor is None:
+                    return ret
+        return asyncio.run(pages()), evts, relay
+    return run
+
+
+def check(pages: list[list], evts: list, limit: int, forward: bool):
+    assert all(len(page) == limit for page in pages[:-1])
+    # each page is oldest first, and so are the pages when walking forward
+    ordered = pages if forward else pages[::-1]
+    got = [event_key(evt) for page in ordered for evt in page]
+    assert got == sorted(event_key(evt) for evt in evts)
+
+
+@pytest.mark.parametrize("forward", [True, False])
+@pytest.mark.parametrize("created_ats", [
+    [NOW + i // 120 for i in range(600)],  # 600 messages over 5 seconds
+    [NOW] * 600,  # all in one second
+    [NOW + i * 7 for i in range(30)] + [NOW + 3 * chat.HISTORY_WINDOW + i for i in range(30)],  # sparse
+], ids=["5s", "1s", "sparse"])
+def test_pages_are_complete(walk, created_ats, forward):
+    pages, evts, _ = walk(created_ats, 50, forward)
+    check(pages, evts, 50, forward)
+
+
+def test_forward_pages_are_bounded(walk):
+    """Every forward page takes a bounded number of relay queries, however the messages are spread."""
+    pages, evts, relay = walk([NOW + i // 120 for i in range(600)], 50, True)
+    check(pages, evts, 50, True)
+    # a handful of queries per page, not one per message
+    assert len(pages) == 12
+    assert len(relay.queries) <= 6 * len(pages)
@@ -0,0 +1,19 @@
+import asyncio
+import pytest
+from conftest import CHANNEL_ID, messages
+
+NOW = 1_700_000_000
+
+
+@pytest.mark.parametrize("the_filter, expected", [
+    ({"kinds": [42], "since": NOW + 2, "until": NOW + 4}, range(2, 5)),
+    ({"since": NOW + 2, "until": NOW + 4}, range(2, 5)),
+    ({"kinds": [42], "#e": [CHANNEL_ID], "since": NOW + 3, "until": NOW + 3}, [3]),
+    ({"kinds": [42], "#e": [CHANNEL_ID], "until": NOW + 5, "limit": 2}, range(4, 6)),
+    ({"until": NOW}, [0]),
+], ids=["kinds", "unindexed", "one second", "limit", "until only"])
+def test_since_until_are_inclusive(store_relay, the_filter, expected):
+    """Both stores return the events at exactly since and until."""
+    relay = store_relay(messages([NOW + i for i in range(10)]))
+    evts = asyncio.run(relay.query([the_filter]))
+    assert sorted(evt.created_at_ticks - NOW for evt in evts) == list(expected)
@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from monstr.encrypt import Keys
+from v1.processors import user as user_module
+
+KEYS = Keys()
+
+
+class SlowUsers:
+    """users collection whose reads wait until `release` is set, holding the document as it was asked for."""
+    def __init__(self):
+        self.release = asyncio.Event()
+
+    def doc(self, uuid: str) -> dict:
+        return {"display_name": "old", "uuid": uuid, "nostr_public_key": KEYS.public_key_hex(),
+                "nostr_private_key": KEYS.private_key_hex(), "joined_chats": []}
+
+    async def find_one(self, query: dict):
+        doc = self.doc(query["uuid"])
+        await self.release.wait()
+        return doc
+
+    async def find(self, query: dict):
+        docs = [self.doc(uuid) for uuid in query["uuid"]["$in"]]
+        await self.release.wait()
+        for doc in docs:
+            yield doc
+
+
+@pytest.fixture
+def users(monkeypatch):
+    monkeypatch.setattr(user_module, "_user_cache", user_module.TTLCache(maxsize=10, ttl=60))
+
+    def read(get):
+        async def run():
+            users = SlowUsers()
+            db = SimpleNamespace(users=users)
+
+            async def get_database():
+                return db
+            monkeypatch.setattr(user_module, "get_database", get_database)
+            read = asyncio.ensure_future(get())
+            await asyncio.sleep(0)
+            # changed by another worker while the read is on its way
+            user_module._invalidate_users(["u1"])
+            users.release.set()
+            return await read
+        return asyncio.run(run())
+    return read
+
+
+def test_get_user_skips_cache_after_invalidation(users):
+    assert users(lambda: user_module.get_user("u1")).display_name == "old"
+    assert "u1" not in user_module._user_cache
+
+
+def test_get_users_skips_cache_after_invalidation(users):
+    assert set(users(lambda: user_module.get_users(["u1", "u2"]))) == {"u1", "u2"}
+    assert "u1" not in user_module._user_cache
+    assert "u2" in user_module._user_cache
@@ -0,0 +1,19 @@
+import base64
+from typing import Optional
+
+# Opaque pagination cursors, a cursor points at a single event by its (created_at, id)
+
+def encode_cursor(created_at: int, event_id: str) -> str:
+    raw = f"{created_at}:{event_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[int, str]]:
+    """Returns (created_at, id) or None if there is no or an invalid cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, event_id = raw.split(":", 1)
+        return int(created_at), event_id
+    except (ValueError, UnicodeDecodeError):
+        return None
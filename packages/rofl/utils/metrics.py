@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional
+from pymongo import monitoring
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Directory the API workers share their metrics through, so /metrics answers for all of them and not only
+# for the worker the scrape reached. Should be emptied before the workers start (start.sh does).
+# Unset, every worker only reports its own
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# How often (seconds) a worker writes its metrics to METRICS_DIR
+METRICS_FLUSH_INTERVAL = 5
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # observations also come from driver threads (pymongo's monitoring runs there)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def values(self) -> dict:
+        """A copy of what was recorded, label values -> value."""
+        raise NotImplementedError
+
+    @staticmethod
+    def add(values: dict, key: tuple, value):
+        """Adds a value of another worker into values."""
+        raise NotImplementedError
+
+    def samples(self, values: dict) -> list[str]:
+        raise NotImplementedError
+
+    def render(self, values: Optional[dict] = None) -> list[str]:
+        values = self.values() if values is None else values
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self.samples(values)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def add(values: dict, key: tuple, value: float):
+        values[key] = values.get(key, 0) + value
+
+    def samples(self, values: dict) -> list[str]:
+        return [f"{self.name}{_labels(self.labels, key)} {_number(value)}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][pos] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def values(self) -> dict:
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def add(values: dict, key: tuple, value: list):
+        entry = values.get(key)
+        if entry is None:
+            values[key] = [list(value[0]), value[1]]
+            return
+        entry[0] = [mine + theirs for mine, theirs in zip(entry[0], value[0])]
+        entry[1] += value[1]
+
+    def samples(self, values: dict) -> list[str]:
+        lines = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else _number(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+_registry: list[Metric] = []
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def write_snapshot(gauges: dict[str, float]):
+    """Writes what this worker recorded to METRICS_DIR, for the worker answering the next scrape."""
+    snapshot = {
+        "metrics": {metric.name: [[list(key), value] for key, value in metric.values().items()] for metric in _registry},
+        "gauges": gauges
+    }
+    path = _snapshot_path(os.getpid())
+    # written next to it and moved over, so a reader never sees half a file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+def _read_snapshots() -> list[tuple[int, dict]]:
+    """(pid, snapshot) of the other workers, including the ones that are gone."""
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        pid, ext = os.path.splitext(name)
+        if ext != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append((int(pid), json.load(f)))
+        except (OSError, ValueError) as e:
+            logging.warning(f"metrics::_read_snapshots {name} {e}")
+    return snapshots
+
+def render(gauges: Optional[dict[str, float]] = None) -> str:
+    """All metrics in the Prometheus text format, plus point-in-time gauges (name -> value).
+    With METRICS_DIR the counters and histograms are summed over all workers (the ones that are gone too,
+    so they never go down), and the gauges of the running workers are given with a worker label."""
+    gauges = gauges or {}
+    snapshots = _read_snapshots() if METRICS_DIR else []
+    lines = []
+    for metric in _registry:
+        values = metric.values()
+        for _, snapshot in snapshots:
+            for key, value in snapshot["metrics"].get(metric.name, []):
+                metric.add(values, tuple(key), value)
+        lines.extend(metric.render(values))
+
+    if not METRICS_DIR:
+        for name, value in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    # name -> [(worker, value)], a gauge only means something while its worker runs
+    by_name: dict[str, list] = {}
+    for pid, worker_gauges in [(os.getpid(), gauges)] + [(pid, snapshot["gauges"]) for pid, snapshot in snapshots
+                                                         if _alive(pid)]:
+        for name, value in worker_gauges.items():
+            by_name.setdefault(name, []).append((pid, value))
+    for name, values in by_name.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f'{name}{{worker="{pid}"}} {_number(value)}' for pid, value in values)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsFlusher:
+    """Writes this worker's metrics to METRICS_DIR every METRICS_FLUSH_INTERVAL seconds and when it stops.
+    `gauges` returns the worker's point-in-time gauges."""
+    def __init__(self, gauges: Callable[[], Awaitable[dict[str, float]]]):
+        self._gauges = gauges
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # the counters outlive the worker, its gauges are left out once it is gone
+        await self._flush()
+
+    async def _flush(self):
+        try:
+            write_snapshot(await self._gauges())
+        except OSError as e:
+            logging.warning(f"MetricsFlusher::_flush {e}")
+
+    async def _run(self):
+        while True:
+            await self._flush()
+            await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+
+# Global flusher instance
+_flusher: Optional[MetricsFlusher] = None
+
+def start_metrics_flush(gauges: Callable[[], Awaitable[dict[str, float]]]):
+    global _flusher
+    if _flusher is None and METRICS_DIR:
+        _flusher = MetricsFlusher(gauges)
+        _flusher.start()
+
+async def stop_metrics_flush():
+    global _flusher
+    if _flusher is not None:
+        await _flusher.stop()
+        _flusher = None
+
+
+# What the app measures
+
+HTTP_REQUEST_SECONDS = Histogram("rofl_http_request_duration_seconds", "Time to answer an API request",
+                                 ("method", "route", "status"))
+STAGE_SECONDS = Histogram("rofl_stage_duration_seconds", "Time spent in a processor step", ("stage",))
+STAGE_ERRORS = Counter("rofl_stage_errors_total", "Processor steps that raised", ("stage",))
+MONGO_SECONDS = Histogram("rofl_mongo_command_duration_seconds", "Time of a MongoDB command",
+                          ("command", "result"))
+RELAY_SECONDS = Histogram("rofl_relay_operation_duration_seconds", "Time of a relay query or publish",
+                          ("operation", "result"))
+SIGNING_SECONDS = Histogram("rofl_signing_duration_seconds", "Time to sign or verify events in the signing executor",
+                            ("operation",))
+LOOP_LAG_SECONDS = Histogram("rofl_event_loop_lag_seconds", "How late the event loop ran a scheduled callback")
+LOOP_STALLS = Counter("rofl_event_loop_stalls_total", "Times the event loop was blocked for longer than the stall threshold")
+
+
+def timed(stage: str) -> Callable:
+    """Decorator for async processor functions, records their duration under STAGE_SECONDS."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                STAGE_ERRORS.inc(stage=stage)
+                raise
+            finally:
+                STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records every HTTP request by its route template, e.g. /v1/historyOf/{chat}."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router puts the matched route into the scope, unmatched paths are counted together
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                         method=scope["method"],
+                                         route=getattr(route, "path", "unmatched"),
+                                         status=status)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Times every command the driver sends, passed to the client with event_listeners."""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name, result="ok")
+
+    def failed(self, event):
+        MONGO_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name, result="error")
@@ -0,0 +1,32 @@
+from typing import Optional
+from monstr.event.event import Event
+
+# Helpers for the event conventions shared by the API and the relay stores
+
+# Only single letter tags are queryable as #<letter> filters (NIP-01), so only those are indexed
+INDEXED_TAG_LEN = 1
+
+
+def event_key(evt: Event) -> tuple[int, str]:
+    """Sort key for events, the created_at second alone isn't unique."""
+    return evt.created_at_ticks, evt.id
+
+def channel_of(evt: Event) -> Optional[str]:
+    """The channel an event belongs to, its root e tag or else the first e tag."""
+    first = None
+    for tag in evt.tags:
+        if len(tag) > 1 and tag[0] == "e":
+            if len(tag) > 3 and tag[3] == "root":
+                return tag[1]
+            if first is None:
+                first = tag[1]
+    return first
+
+def matches(evt: Event, the_filter: dict) -> bool:
+    """Whether an event passes a filter, with since and until inclusive as NIP-01 has them.
+    monstr's Event.test leaves out events at either bound, so it only gets to check the rest."""
+    if "since" in the_filter and evt.created_at_ticks < the_filter["since"]:
+        return False
+    if "until" in the_filter and evt.created_at_ticks > the_filter["until"]:
+        return False
+    return evt.test({name: value for name, value in the_filter.items() if name not in ("since", "until")})
@@ -0,0 +1,173 @@
+import os
+import sys
+import hmac
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from types import FrameType
+from typing import Optional
+from utils.metrics import LOOP_LAG_SECONDS, LOOP_STALLS
+
+# Token the /admin endpoints require in the X-Admin-Token header, they are disabled without one
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Longest profile a single request may ask for, in seconds
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# Shortest pause between two samples, in seconds, anything shorter would keep a core busy
+PROFILE_MIN_INTERVAL = 0.001
+# Seconds between two heartbeats of the event loop monitor, and how late one may be before it counts as a stall
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+# Stalls (with their stacks) kept for /admin/loop
+LOOP_STALLS_KEPT = 50
+
+
+def check_admin_token(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{'/'.join(path[-2:])}:{code.co_name}".replace(";", ":")
+
+def folded_stack(frame: Optional[FrameType]) -> str:
+    """A stack in the folded format of flamegraph.pl / speedscope, outermost call first."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def _sample(seconds: float, interval: float) -> Counter:
+    """Runs in its own thread, samples the stacks of all other threads every interval."""
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                samples[f"{names.get(ident, ident)};{folded_stack(frame)}"] += 1
+        time.sleep(interval)
+    return samples
+
+
+_profile_lock = asyncio.Lock()
+
+async def sample_profile(seconds: float, interval: float = 0.005) -> Optional[str]:
+    """Samples every thread of this process for `seconds` and returns the folded stacks with their counts,
+    one "stack count" line each. Returns None when another profile is already running."""
+    if _profile_lock.locked():
+        return None
+    async with _profile_lock:
+        interval = max(interval, PROFILE_MIN_INTERVAL)
+        seconds = min(max(seconds, interval), PROFILE_MAX_SECONDS)
+        loop = asyncio.get_running_loop()
+        # a thread of its own, an executor's workers may be busy with what we want to see
+        done: asyncio.Future = loop.create_future()
+
+        def run():
+            try:
+                result = _sample(seconds, interval)
+                loop.call_soon_threadsafe(done.set_result, result)
+            except Exception as e:
+                loop.call_soon_threadsafe(done.set_exception, e)
+
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+        samples = await done
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+class LoopMonitor:
+    """Measures how late the event loop runs its callbacks.
+    A task on the loop beats every LOOP_MONITOR_INTERVAL, a watchdog thread notices when the beats stop
+    and captures the loop thread's stack while it is still stuck.
+    """
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: deque = deque(maxlen=LOOP_STALLS_KEPT)
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        # the stall the watchdog is looking at right now, completed by the loop once it runs again
+        self._current: Optional[dict] = None
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            stall = self._current
+            if stall is not None:
+                stall["lag_ms"] = round(lag * 1000, 1)
+                self._current = None
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            late = time.monotonic() - self._heartbeat - self.interval
+            if late < self.threshold or self._current is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stall = {
+                "at": time.time(),
+                # filled in by the loop when it gets to run again, until then it is still stalled
+                "lag_ms": None,
+                "stack": folded_stack(frame)
+            }
+            self._current = stall
+            self.stalls.append(stall)
+            LOOP_STALLS.inc()
+            logging.warning(f"event loop stalled for more than {round(late * 1000)}ms in {stall['stack'].rsplit(';', 1)[-1]}")
+
+    def stats(self) -> dict:
+        return {
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stalls": list(self.stalls)
+        }
+
+
+# Global monitor instance
+_monitor: Optional[LoopMonitor] = None
+
+def get_loop_monitor() -> Optional[LoopMonitor]:
+    return _monitor
+
+def start_loop_monitor():
+    global _monitor
+    if _monitor is None and LOOP_MONITOR_INTERVAL > 0:
+        _monitor = LoopMonitor()
+        _monitor.start()
+
+async def stop_loop_monitor():
+    global _monitor
+    if _monitor is not None:
+        await _monitor.stop()
+        _monitor = None
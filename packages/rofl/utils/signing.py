@@ -0,0 +1,75 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from monstr.event.event import Event
+from utils.metrics import SIGNING_SECONDS
+
+# Schnorr signing/verifying runs in an executor so it doesn't stall the event loop,
+# "thread" shares the process, "process" also keeps the crypto off this interpreter's GIL
+SIGNING_EXECUTOR = os.getenv("SIGNING_EXECUTOR", "thread")
+SIGNING_WORKERS = int(os.getenv("SIGNING_WORKERS", str(os.cpu_count() or 1)))
+# Events signed per executor call, batching keeps the hand-off cost per event low
+SIGNING_BATCH_SIZE = int(os.getenv("SIGNING_BATCH_SIZE", "64"))
+
+
+def _sign_batch(batch: list[tuple[dict, str]]) -> list[dict]:
+    """Runs in the executor. Works on plain event dicts so it can cross process boundaries."""
+    signed = []
+    for data, private_key_hex in batch:
+        evt = Event.load(data)
+        evt.sign(private_key_hex)
+        signed.append(evt.data())
+    return signed
+
+def _verify(data: dict) -> bool:
+    """Runs in the executor, the same signature check the relay does with Event.is_valid."""
+    return Event.load(data).is_valid()
+
+
+# Global executor instance
+_executor: Optional[Executor] = None
+
+def get_signing_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if SIGNING_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=SIGNING_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=SIGNING_WORKERS, thread_name_prefix="signing")
+        logging.info(f"signing executor: {SIGNING_EXECUTOR} with {SIGNING_WORKERS} workers")
+    return _executor
+
+def close_signing_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def sign_events(items: list[tuple[Event, str]]) -> list[Event]:
+    """Signs (event, private key hex) pairs in the executor, in batches. Returns the signed events in order."""
+    if not items:
+        return []
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    executor = get_signing_executor()
+    batches = [items[i:i + SIGNING_BATCH_SIZE] for i in range(0, len(items), SIGNING_BATCH_SIZE)]
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, _sign_batch, [(evt.data(), private_key_hex) for evt, private_key_hex in batch])
+        for batch in batches
+    ])
+    SIGNING_SECONDS.observe(time.perf_counter() - started, operation="sign")
+    return [Event.load(data) for signed in results for data in signed]
+
+async def sign_event(evt: Event, private_key_hex: str) -> Event:
+    """Signs a single event in the executor and returns the signed event."""
+    signed = await sign_events([(evt, private_key_hex)])
+    return signed[0]
+
+async def verify_event(evt: Event) -> bool:
+    """Checks an event's signature in the executor."""
+    loop = asyncio.get_running_loop()
+    with SIGNING_SECONDS.time(operation="verify"):
+        return await loop.run_in_executor(get_signing_executor(), _verify, evt.data())
@@ -0,0 +1,280 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Callable, Optional
+from monstr.client.client import Client
+from monstr.event.event import Event
+from monstr.util import util_funcs
+from utils.metrics import RELAY_SECONDS
+
+# Nostr relay connection settings
+NOSTR_URL = os.getenv("NOSTR_URL", "ws://monstr:8082")
+# Number of persistent websocket connections kept open to the relay
+NOSTR_POOL_SIZE = int(os.getenv("NOSTR_POOL_SIZE", "2"))
+# The monstr relay allows 10 open subscriptions per websocket by default
+NOSTR_MAX_SUBS = int(os.getenv("NOSTR_MAX_SUBS", "10"))
+# Seconds to wait for a connection / a query before giving up
+NOSTR_CONNECT_TIMEOUT = float(os.getenv("NOSTR_CONNECT_TIMEOUT", "5"))
+NOSTR_QUERY_TIMEOUT = float(os.getenv("NOSTR_QUERY_TIMEOUT", "10"))
+# Events published but not acknowledged yet, further publishes wait for room
+NOSTR_PUBLISH_WINDOW = int(os.getenv("NOSTR_PUBLISH_WINDOW", "100"))
+# Seconds to wait for the relay's OK, and how often a publish is tried again after a timeout or a retryable error
+NOSTR_PUBLISH_TIMEOUT = float(os.getenv("NOSTR_PUBLISH_TIMEOUT", "5"))
+NOSTR_PUBLISH_RETRIES = int(os.getenv("NOSTR_PUBLISH_RETRIES", "3"))
+
+# NIP-20 OK messages with these prefixes are worth another try, other refusals are final
+RETRYABLE_PREFIXES = ("error:", "rate-limited:")
+# Ack latencies kept for the percentiles in stats()
+LATENCY_SAMPLES = 1000
+
+
+class RelayPublishError(ConnectionError):
+    """The relay refused an event or never acknowledged it."""
+
+
+class RelayConnection:
+    """A single persistent websocket to the relay.
+    monstr's Client reconnects on its own (with backoff) for as long as it is running.
+    """
+    def __init__(self, url: str, max_subs: int, on_ok: Optional[Callable] = None):
+        self.client = Client(url, timeout=int(NOSTR_CONNECT_TIMEOUT), on_connect=self._on_connect, on_ok=on_ok)
+        # bounds the number of concurrent subscriptions so we stay under the relay's max_sub
+        self.slots = asyncio.Semaphore(max_subs)
+        self.task: Optional[asyncio.Task] = None
+        # long lived subscriptions, sub_id -> (filters func, handler, eose func)
+        self.subs: dict[str, tuple[Callable[[], list[dict]], Callable, Optional[Callable]]] = {}
+
+    def _on_connect(self, the_client: Client):
+        # the relay forgets our subscriptions when the connection drops
+        for sub_id in self.subs:
+            self.resubscribe(sub_id)
+
+    def resubscribe(self, sub_id: str):
+        filters, handler, eose_func = self.subs[sub_id]
+        self.client.subscribe(sub_id=sub_id, handlers=handler, filters=filters(), eose_func=eose_func)
+
+    def start(self):
+        self.task = asyncio.create_task(self.client.run())
+
+    def close(self):
+        self.client.end()
+
+    @property
+    def connected(self) -> bool:
+        return self.client.connected
+
+
+class RelayPool:
+    """Multiplexes queries and publishes over a small pool of long-lived relay connections."""
+    def __init__(self, url: str = NOSTR_URL, size: int = NOSTR_POOL_SIZE, max_subs: int = NOSTR_MAX_SUBS,
+                 publish_window: int = NOSTR_PUBLISH_WINDOW):
+        self.url = url
+        self._connections = [RelayConnection(url, max_subs, on_ok=self._on_ok) for _ in range(max(1, size))]
+        self._next = 0
+
+        # event id -> future resolved with (success, message) when the relay's OK comes in
+        self._pending: dict[str, asyncio.Future] = {}
+        # event id -> the task publishing it, whoever publishes the same event meanwhile waits for that
+        self._publishing: dict[str, asyncio.Future] = {}
+        self._window = asyncio.Semaphore(publish_window)
+        self._waiting = 0
+        self._acked = 0
+        self._failed = 0
+        self._retries = 0
+        self._latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+
+    async def start(self):
+        for conn in self._connections:
+            conn.start()
+        try:
+            await self.wait_connect()
+        except ConnectionError as e:
+            # the clients keep retrying in the background, requests will wait for them
+            logging.warning(f"RelayPool::start {e}")
+
+    async def close(self):
+        for conn in self._connections:
+            conn.close()
+        tasks = [conn.task for conn in self._connections if conn.task]
+        if tasks:
+            await asyncio.wait(tasks, timeout=NOSTR_CONNECT_TIMEOUT)
+
+    async def wait_connect(self, timeout: float = NOSTR_CONNECT_TIMEOUT):
+        """Waits until at least one connection of the pool is up."""
+        waited = 0.0
+        while not any(conn.connected for conn in self._connections):
+            if waited >= timeout:
+                raise ConnectionError(f"RelayPool::wait_connect no connection to {self.url} after {timeout}s")
+            await asyncio.sleep(0.05)
+            waited += 0.05
+
+    def _pick(self) -> RelayConnection:
+        """Round robin over the pool, preferring connections that are currently up."""
+        size = len(self._connections)
+        for i in range(size):
+            conn = self._connections[(self._next + i) % size]
+            if conn.connected:
+                self._next = (self._next + i + 1) % size
+                return conn
+        conn = self._connections[self._next]
+        self._next = (self._next + 1) % size
+        return conn
+
+    async def query(self, filters, timeout: float = NOSTR_QUERY_TIMEOUT) -> list[Event]:
+        """One-off REQ that resolves as soon as the relay sends EOSE."""
+        if isinstance(filters, dict):
+            filters = [filters]
+
+        started = time.perf_counter()
+        result = "error"
+        await self.wait_connect()
+        conn = self._pick()
+        async with conn.slots:
+            loop = asyncio.get_running_loop()
+            done: asyncio.Future = loop.create_future()
+
+            def on_eose(the_client: Client, sub_id: str, events: list[Event]):
+                # with an async store the relay can send an event that was being saved twice
+                if not done.done():
+                    done.set_result(list({evt.id: evt for evt in events}.values()))
+
+            sub_id = conn.client.subscribe(sub_id=util_funcs.get_rnd_hex_str(8),
+                                           filters=filters,
+                                           eose_func=on_eose)
+            try:
+                events = await asyncio.wait_for(done, timeout)
+                result = "ok"
+                return events
+            except asyncio.TimeoutError:
+                result = "timeout"
+                raise
+            finally:
+                conn.client.unsubscribe(sub_id)
+                RELAY_SECONDS.observe(time.perf_counter() - started, operation="query", result=result)
+
+    async def subscribe(self, filters: Callable[[], list[dict]], handler: Callable,
+                        eose_func: Optional[Callable] = None) -> str:
+        """Opens a long lived subscription that is re-sent whenever its connection comes back.
+        `filters` is called on every (re)subscribe so the caller can move `since` forward."""
+        conn = self._pick()
+        # held for as long as the subscription is open
+        await conn.slots.acquire()
+        sub_id = util_funcs.get_rnd_hex_str(8)
+        conn.subs[sub_id] = (filters, handler, eose_func)
+        if conn.connected:
+            conn.resubscribe(sub_id)
+        return sub_id
+
+    def unsubscribe(self, sub_id: str):
+        for conn in self._connections:
+            if sub_id in conn.subs:
+                del conn.subs[sub_id]
+                conn.client.unsubscribe(sub_id)
+                conn.slots.release()
+
+    def _on_ok(self, the_client: Client, event_id: str, success: bool, message: str):
+        done = self._pending.get(event_id)
+        if done is not None and not done.done():
+            done.set_result((success, message))
+
+    async def publish(self, evt: Event, timeout: float = NOSTR_PUBLISH_TIMEOUT, retries: int = NOSTR_PUBLISH_RETRIES):
+        """Publishes an event and returns once the relay acknowledged it with OK.
+        Raises RelayPublishError when it refused the event or never answered."""
+        # the same text from the same user in the same second is the same event (a double submit),
+        # its publishes share one attempt instead of racing for the relay's single OK
+        publishing = self._publishing.get(evt.id)
+        if publishing is None:
+            publishing = self._publishing[evt.id] = asyncio.ensure_future(self._publish(evt, timeout, retries))
+            publishing.add_done_callback(lambda task: self._publishing.pop(evt.id, None)
+                                         if self._publishing.get(evt.id) is task else None)
+        # a caller that gives up doesn't cancel the publish for the others
+        await asyncio.shield(publishing)
+
+    async def _publish(self, evt: Event, timeout: float, retries: int):
+        started = time.perf_counter()
+        result = "error"
+        self._waiting += 1
+        try:
+            await self._window.acquire()
+        finally:
+            self._waiting -= 1
+
+        try:
+            loop = asyncio.get_running_loop()
+            message = "no OK received"
+            for attempt in range(retries + 1):
+                if attempt:
+                    self._retries += 1
+                    await asyncio.sleep(min(0.1 * 2 ** attempt, 2))
+                try:
+                    await self.wait_connect()
+                except ConnectionError as e:
+                    message = str(e)
+                    continue
+
+                done = self._pending[evt.id] = loop.create_future()
+                sent_at = time.monotonic()
+                # a publish on a connection that is down is dropped by the client, the timeout catches that
+                self._pick().client.publish(evt)
+                try:
+                    success, message = await asyncio.wait_for(done, timeout)
+                except asyncio.TimeoutError:
+                    message = "no OK received"
+                    continue
+                finally:
+                    self._pending.pop(evt.id, None)
+
+                # the relay already having the event is as good as storing it now
+                if success or message.startswith("duplicate:"):
+                    self._acked += 1
+                    self._latencies.append(time.monotonic() - sent_at)
+                    result = "ok"
+                    return
+                # monstr answers false with an empty message when its store failed
+                if message and not message.startswith(RETRYABLE_PREFIXES):
+                    break
+
+            self._failed += 1
+            raise RelayPublishError(f"RelayPool::publish {evt.id} not accepted by {self.url}: {message}")
+        finally:
+            self._window.release()
+            # includes the wait for room in the publish window and the retries
+            RELAY_SECONDS.observe(time.perf_counter() - started, operation="publish", result=result)
+
+    def stats(self) -> dict:
+        """Publish pipeline counters, ack latencies in milliseconds over the last LATENCY_SAMPLES acks."""
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2) if latencies else 0.0
+
+        return {
+            "publish_queue_depth": self._waiting,
+            "publish_in_flight": len(self._pending),
+            "publish_acked": self._acked,
+            "publish_failed": self._failed,
+            "publish_retries": self._retries,
+            "ack_latency_p50_ms": percentile(0.5),
+            "ack_latency_p99_ms": percentile(0.99)
+        }
+
+
+# Global pool instance
+_pool: Optional[RelayPool] = None
+
+async def get_relay() -> RelayPool:
+    """Get the relay pool. Starts it if it isn't running yet."""
+    global _pool
+    if _pool is None:
+        _pool = RelayPool()
+        await _pool.start()
+    return _pool
+
+async def close_relay():
+    """Close all relay connections."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
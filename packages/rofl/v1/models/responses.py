@@ -0,0 +1,80 @@
+from typing import Any, Generic, Optional, TypeVar
+from pydantic import BaseModel, ConfigDict
+
+T = TypeVar("T")
+
+class ResponseModel(BaseModel):
+    """Base of the response models, they read the processors' objects by attribute."""
+    model_config = ConfigDict(from_attributes=True)
+
+class ResultResponse(ResponseModel, Generic[T]):
+    """Wire shape of a RoflStatus Success or Error:
+
+        {"message": "<what happened>", "value": <result, or null>}
+
+    Both look the same on the wire, errors are told apart by their message.
+    """
+    message: str
+    value: Optional[T] = None
+
+class ErrorResponse(ResponseModel):
+    error: str
+
+class StatusResponse(ResponseModel):
+    status: str
+
+class UserResponse(ResponseModel):
+    display_name: str
+    uuid: str
+    joined_chats: list[str]
+
+class MessageResponse(ResponseModel):
+    uuid: str
+    sender: str
+    message: str
+    sent_at: float
+    chat_id: str
+
+class FeedEntryResponse(MessageResponse):
+    """The newest message of a chat in a user's feed, with how many of its messages the user hasn't read."""
+    message_count: int = 0
+    read_seq: int = 0
+    unread: int = 0
+
+class ReadCursorResponse(ResponseModel):
+    chat_id: str
+    read_seq: int
+    unread: int
+
+class ChatResponse(ResponseModel):
+    uuid: str
+    creator: Optional[str] = None
+    name: str
+    description: str
+    messages: list[MessageResponse]
+    last_msg_at: float
+    amount_of_members: int
+    amount_of_messages: int
+    members: list[str]
+    next_cursor: Optional[str] = None
+
+class ChatSummaryResponse(ResponseModel):
+    chat_id: str
+    creator: Optional[str] = None
+    name: str
+    description: str
+    picture: str
+    amount_of_members: int
+    amount_of_messages: int
+    last_msg_at: float
+
+class ChatDirectoryResponse(ResponseModel):
+    chats: list[ChatSummaryResponse]
+    next_cursor: Optional[str] = None
+
+class SearchResponse(ResponseModel):
+    results: list[MessageResponse]
+    next_offset: Optional[int] = None
+
+# results without a meaningful value
+EmptyResult = ResultResponse[Any]
@@ -9,4 +9,5 @@ class UserDB(BaseModel):
     uuid: str  # Using str for UUID for simplicity in JSON serialization
     nostr_public_key: str  # Store only the public key
     nostr_private_key: str  # Store encrypted private key
-    joined_chats: list[str]  # List of chat UUIDs
\ No newline at end of file
+    joined_chats: list[str]  # List of chat UUIDs
+    read_cursors: dict[str, int] = {}  # chat UUID -> how many of its messages the user has read
\ No newline at end of file
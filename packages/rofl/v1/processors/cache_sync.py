@@ -0,0 +1,118 @@
+import os
+import json
+import logging
+from typing import Callable, Optional
+from monstr.client.client import Client
+from monstr.encrypt import Keys
+from monstr.event.event import Event
+from v1.config.relay import get_relay, RelayPublishError
+from utils.signing import sign_event
+
+# Number of API worker processes, set by start.sh / compose.yaml
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+# Tell the other workers when a cached entry changed, only needed when there is more than one
+CACHE_SYNC = os.getenv("CACHE_SYNC", "on" if API_WORKERS > 1 else "off") == "on"
+
+# Ephemeral kind (NIP-16), the relay forwards it to subscribers but doesn't store it
+KIND_CACHE_INVALIDATE = 20021
+
+# scope -> handlers called with the invalidated keys, or None when everything may be stale
+_handlers: dict[str, list[Callable[[Optional[list[str]]], None]]] = {}
+
+def on_invalidate(scope: str, handler: Callable[[Optional[list[str]]], None]):
+    """Registers a handler for invalidations of a scope (e.g. "user") sent by other workers."""
+    _handlers.setdefault(scope, []).append(handler)
+
+def _notify(scope: str, keys: Optional[list[str]]):
+    for handler in _handlers.get(scope, []):
+        handler(keys)
+
+
+class CacheSync:
+    """Keeps the in-process caches of all API workers coherent.
+    A worker that changes something publishes the changed keys as an ephemeral event, signed with a key
+    of its own, the other workers are subscribed and drop those keys from their caches.
+    """
+    def __init__(self):
+        # a fresh key per process, that's how a worker recognises (and skips) its own invalidations
+        self._keys = Keys()
+        self._sub_id: Optional[str] = None
+        self._subscribed = False
+        self._received = 0
+        self._sent = 0
+
+    async def start(self):
+        relay = await get_relay()
+        self._sub_id = await relay.subscribe(filters=self._filters, handler=self._on_event)
+
+    async def stop(self):
+        if self._sub_id is not None:
+            relay = await get_relay()
+            relay.unsubscribe(self._sub_id)
+            self._sub_id = None
+
+    def _filters(self) -> list[dict]:
+        # ephemeral events aren't kept, whatever was sent while we were disconnected is lost for good
+        if self._subscribed:
+            for scope in _handlers:
+                _notify(scope, None)
+        self._subscribed = True
+        return [{"kinds": [KIND_CACHE_INVALIDATE]}]
+
+    def _on_event(self, the_client: Client, sub_id: str, evt: Event):
+        if evt.pub_key == self._keys.public_key_hex():
+            return
+        try:
+            data = json.loads(evt.content)
+            scope, keys = data["scope"], data["keys"]
+        except (ValueError, KeyError, TypeError):
+            logging.debug(f"CacheSync::_on_event ignoring {evt.id}")
+            return
+        self._received += 1
+        _notify(scope, keys)
+
+    async def publish(self, scope: str, keys: list[str]):
+        """Sends an invalidation and waits for the relay's OK, by then it went out to the other workers."""
+        evt = Event(
+            kind=KIND_CACHE_INVALIDATE,
+            content=json.dumps({"scope": scope, "keys": keys}),
+            pub_key=self._keys.public_key_hex()
+        )
+        evt = await sign_event(evt, self._keys.private_key_hex())
+        relay = await get_relay()
+        try:
+            await relay.publish(evt)
+            self._sent += 1
+        except RelayPublishError as e:
+            # the change itself is saved, the other workers catch up when their cached entry expires
+            logging.warning(f"CacheSync::publish {e}")
+
+    def stats(self) -> dict:
+        return {
+            "cache_invalidations_sent": self._sent,
+            "cache_invalidations_received": self._received
+        }
+
+
+# Global instance, None when there is only one worker
+_sync: Optional[CacheSync] = None
+
+def get_cache_sync() -> Optional[CacheSync]:
+    return _sync
+
+async def start_cache_sync():
+    global _sync
+    if _sync is None and CACHE_SYNC:
+        _sync = CacheSync()
+        await _sync.start()
+
+async def stop_cache_sync():
+    global _sync
+    if _sync is not None:
+        await _sync.stop()
+        _sync = None
+
+async def invalidate(scope: str, keys: list[str]):
+    """Drops the keys of a scope from the caches of the other workers, a no-op with a single worker."""
+    if _sync is not None and keys:
+        await _sync.publish(scope, keys)
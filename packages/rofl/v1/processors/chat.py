@@ -1,26 +1,92 @@
 from __future__ import annotations
-import uuid
 import time
 import json
 from utils.rofl_status import RoflStatus
-from monstr.client.client import Client
 from monstr.event.event import Event
 from typing import TYPE_CHECKING, Optional
-import asyncio
+from v1.config.relay import get_relay, RelayPublishError
+from utils.signing import sign_event
+from utils.metrics import timed
+from utils.cursor import encode_cursor, decode_cursor
+from utils.nostr import event_key
+from v1.processors.chat_counts import add_message_counts, get_message_counts
+from v1.processors.chat_view import get_chat_view, ChatState, KIND_CHANNEL_JOIN, KIND_CHANNEL_LEAVE, MEMBERSHIP_KINDS
 
 if TYPE_CHECKING:
     from v1.processors.user import User
 
-nostr_url = "ws://monstr:8082"
+# Default and maximum amount of messages returned per history page
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+# Default and maximum amount of chats returned per directory page
+CHATS_PAGE_SIZE = 50
+CHATS_MAX_PAGE_SIZE = 500
+# Seconds of history the first relay query of a forward page covers, halved or doubled to fit a page
+HISTORY_WINDOW = 3600
 
 class Message:
-    def __init__(self, sender: str, message: str, chat_id: str):
+    """A chat message as stored in its kind-42 event, the event id is its uuid and created_at its sent_at.
+    Histories hold many of these, so there's no __dict__ and nothing is computed per message."""
+    __slots__ = ("uuid", "sender", "message", "sent_at", "chat_id")
+
+    def __init__(self, uuid: str, sender: str, message: str, sent_at: int, chat_id: str):
+        self.uuid = uuid
         self.sender = sender
         self.message = message
-        self.uuid = str(uuid.uuid4())
-        self.sent_at = time.time()
+        self.sent_at = sent_at
         self.chat_id = chat_id
 
+    @classmethod
+    def from_event(cls, evt: Event, chat_id: str, sender: Optional[str] = None) -> "Message":
+        """The message of an event, sent by its pubkey unless another sender (a user uuid) is given."""
+        return cls(evt.id, sender or evt.pub_key, evt.content, evt.created_at_ticks, chat_id)
+
+def message_event(user: "User", channel_id: str, message: str) -> Event:
+    """An unsigned kind-42 message of the user in the channel."""
+    msg_evt = Event(
+        kind=Event.KIND_CHANNEL_MESSAGE,   # 42
+        content=message,
+        pub_key=user.public_key_hex,
+        tags=[["e", channel_id, "", "root"]]   # the channel id is the hash of its create event
+    )
+    return msg_evt
+
+def membership_event(user: "User", channel_id: str, kind: int, created_at: Optional[int] = None) -> Event:
+    """An unsigned join/leave event of the user for the channel, members are tracked by their Nostr pubkey."""
+    return Event(
+        kind=kind,
+        content="",
+        pub_key=user.public_key_hex,
+        tags=[["e", channel_id]],
+        created_at=created_at
+    )
+
+class ChatSummary:
+    """What the chat directory shows of a chat, without its messages."""
+    def __init__(self, state: "ChatState", message_count: int):
+        self.chat_id = state.channel_id
+        self.creator = state.creator
+        self.name = state.name
+        self.description = state.about
+        self.picture = state.picture
+        self.amount_of_members = len(state.members)
+        self.amount_of_messages = message_count
+        self.last_msg_at = state.last_activity
+
+class FeedEntry:
+    """A chat in a user's feed: its newest message, plus how many of its messages the user hasn't read."""
+    __slots__ = ("uuid", "sender", "message", "sent_at", "chat_id", "message_count", "read_seq", "unread")
+
+    def __init__(self, message: Message, message_count: int, read_seq: int):
+        self.uuid = message.uuid
+        self.sender = message.sender
+        self.message = message.message
+        self.sent_at = message.sent_at
+        self.chat_id = message.chat_id
+        self.message_count = message_count
+        self.read_seq = read_seq
+        self.unread = max(0, message_count - read_seq)
+
 class Chat:
     def __init__(self, creator: str, name: str, description: str, channel_id: str):
         self.creator = creator
@@ -32,7 +98,9 @@ class Chat:
         self.amount_of_messages = 0
         self.members = []
         self.uuid = channel_id
-        
+        # cursor of the next history page, only set when the messages were paginated
+        self.next_cursor = None
+
     #async def save(self):
         #"""This method is kept for compatibility with existing code.
         #All data is already stored in Nostr, so no additional saving is needed."""
@@ -41,20 +109,20 @@ class Chat:
 
     @classmethod
     async def create(cls, creator: "User", name: str, description: str = "", image_url: str = "") -> "Chat":
-        async with Client(nostr_url) as client:
-            await client.wait_connect()
-
-            channel_evt = Event(
-                kind=Event.KIND_CHANNEL_CREATE,   # 40
-                content=json.dumps({
-                    "name": name,
-                    "about": description,
-                    "picture": image_url
-                }),
-                pub_key=creator.nostr_key.public_key_hex()
-            )
-            channel_evt.sign(creator.nostr_key.private_key_hex())
-            client.publish(channel_evt)
+        relay = await get_relay()
+
+        channel_evt = Event(
+            kind=Event.KIND_CHANNEL_CREATE,   # 40
+            content=json.dumps({
+                "name": name,
+                "about": description,
+                "picture": image_url
+            }),
+            pub_key=creator.public_key_hex
+        )
+        channel_evt = await sign_event(channel_evt, creator.private_key_hex)
+        # waits for the relay's OK, so the chat can be read right away
+        await relay.publish(channel_evt)
 
         # the real channel ID is the *event hash*
         chat = cls(
@@ -68,34 +136,58 @@ class Chat:
     async def new_message(self, user: "User", message: str) -> "RoflStatus":
         if self.uuid not in user.joined_chats:
             return RoflStatus.ERROR.create(f"User {user.uuid} is not in this group {self.uuid}")
-        new_user_message = Message(user.uuid, message, self.uuid)
+        relay = await get_relay()
+        msg_evt = await sign_event(message_event(user, self.uuid, message), user.private_key_hex)
+        try:
+            await relay.publish(msg_evt)
+        except RelayPublishError as e:
+            return RoflStatus.ERROR.create(f"Message from {user.uuid} wasn't accepted by the relay: {e}")
+        await add_message_counts({self.uuid: 1})
+        new_user_message = Message.from_event(msg_evt, self.uuid, sender=user.uuid)
         self.messages.append(new_user_message)
         self.amount_of_messages += 1
-        self.last_msg_at = time.time()
-        async with Client(nostr_url) as client:
-            await client.wait_connect()
-            msg_evt = Event(
-                kind=Event.KIND_CHANNEL_MESSAGE,   # 42
-                content=message,
-                pub_key=user.nostr_key.public_key_hex(),
-                tags=[["e", self.uuid, "", "root"]]   # self.uuid is now the hash
-            )
-            msg_evt.sign(user.nostr_key.private_key_hex())
-            client.publish(msg_evt)
+        self.last_msg_at = new_user_message.sent_at
         return RoflStatus.SUCCESS.create(f"Managed to send the new message from {user.uuid}", new_user_message)
 
+    async def _publish_membership(self, user: "User", kind: int):
+        """Publishes a signed join/leave event, members are tracked by their Nostr pubkey.
+        Raises RelayPublishError if the relay doesn't accept it."""
+        relay = await get_relay()
+        user_pubkey = user.public_key_hex
+        # the newest event decides, so it must not share a second with the previous join/leave
+        created_at = int(time.time())
+        view = get_chat_view()
+        state = view.get(self.uuid) if view else None
+        if state is not None:
+            created_at = max(created_at, state.membership_at(user_pubkey) + 1)
+
+        membership_evt = await sign_event(membership_event(user, self.uuid, kind, created_at), user.private_key_hex)
+        await relay.publish(membership_evt)
+        # so the next read already sees it, the subscription delivers it again later
+        if view:
+            view.apply(membership_evt)
+
     async def join_chat(self, user: "User") -> "RoflStatus":
-        self.members.append(user.uuid)
-        self.amount_of_members += 1
+        try:
+            await self._publish_membership(user, KIND_CHANNEL_JOIN)
+        except RelayPublishError as e:
+            return RoflStatus.ERROR.create(f"User {user.uuid} couldn't join the chat {self.uuid}: {e}")
+        user_pubkey = user.public_key_hex
+        if user_pubkey not in self.members:
+            self.members.append(user_pubkey)
+            self.amount_of_members += 1
         return RoflStatus.SUCCESS.create(f"User {user.uuid} joined the chat {self.uuid}")
 
     async def leave_chat(self, user: "User") -> "RoflStatus":
-        # Use the user's Nostr pubkey instead of UUID for member list
-        user_pubkey = user.nostr_key.public_key_hex()
-        if user_pubkey not in self.members:
-            return RoflStatus.ERROR.create(f"User {user.uuid} is not in chat {self.uuid}")
-        self.members.remove(user_pubkey)
-        self.amount_of_members -= 1
+        # whether the user is in the chat is decided by its joined_chats, so always record the leave
+        try:
+            await self._publish_membership(user, KIND_CHANNEL_LEAVE)
+        except RelayPublishError as e:
+            return RoflStatus.ERROR.create(f"User {user.uuid} couldn't leave the chat {self.uuid}: {e}")
+        user_pubkey = user.public_key_hex
+        if user_pubkey in self.members:
+            self.members.remove(user_pubkey)
+            self.amount_of_members -= 1
         return RoflStatus.SUCCESS.create(f"User {user.uuid} left the chat {self.uuid}")
 
     def get_messages(self) -> "RoflStatus":
@@ -105,74 +197,248 @@ class Chat:
             return RoflStatus.SUCCESS.create(f"Got the messages from {self.uuid}", self.messages)
 
     def get_last_message(self) -> "Message" | None:
-        if self.amount_of_messages == 0:
+        if not self.messages:
             return None
         else:
-            return self.messages[self.amount_of_messages - 1]
+            return self.messages[-1]
 
-async def get_chat(channel_id: str):
-    async with Client(nostr_url) as client:
-        await client.wait_connect()
+@timed("get_message_page")
+async def get_message_page(channel_id: str, limit: int = HISTORY_PAGE_SIZE,
+                           before: Optional[str] = None, after: Optional[str] = None) -> tuple[list[Event], Optional[str]]:
+    """Returns a page of kind-42 events of a channel, oldest first, and the cursor of the next page.
+    Without `after` the pages walk back from the newest message (pass the cursor as `before`),
+    with `after` they walk forward from the cursor (pass the cursor as `after`)."""
+    relay = await get_relay()
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    before_key = decode_cursor(before)
+    after_key = decode_cursor(after)
+    # since/until are inclusive (NIP-01), so the cursor's second is fetched and in_range cuts exactly at the cursor
+    base = {"kinds": [Event.KIND_CHANNEL_MESSAGE], "#e": [channel_id]}
+    if before_key:
+        base["until"] = before_key[0]
 
-        # 1. fetch the channel-create event
-        chan = await client.query([{
-            "kinds": [Event.KIND_CHANNEL_CREATE],
-            "ids":   [channel_id]
-        }])
+    def in_range(evt: Event) -> bool:
+        key = event_key(evt)
+        return (before_key is None or key < before_key) and (after_key is None or key > after_key)
 
-        print(f"Chan: {chan}")
+    if after_key:
+        # nostr limits always keep the newest events, so walking forward goes through windows of time.
+        # A window the limit cut is narrowed to its part that is missing, one that fits is taken whole
+        # and the next one is made twice as long
+        last = before_key[0] if before_key else int(time.time())
+        fetch = limit + 1
+        newer = []
+        start = after_key[0]
+        span = HISTORY_WINDOW
+        while start <= last and len(newer) <= limit:
+            end = min(start + span, last)
+            the_filter = {**base, "since": start, "until": end}
+            # a second that alone holds more than a page is fetched whole, a limit can't page within it
+            if span > 0:
+                the_filter["limit"] = fetch
+            evts = await relay.query([the_filter])
+            if span > 0 and len(evts) >= fetch:
+                # everything after the oldest second came back, but that second may be cut as well,
+                # so the window ends right before it and gets shorter every time
+                oldest = min(evt.created_at_ticks for evt in evts)
+                span = max(0, oldest - 1 - start)
+                continue
+            newer.extend(filter(in_range, evts))
+            start = end + 1
+            span = max(1, span * 2)
+        newer.sort(key=event_key)
+        page = newer[:limit]
+        next_cursor = encode_cursor(*event_key(page[-1])) if len(newer) > limit else None
+        return page, next_cursor
 
-        if not chan:
-            return None
-        chan_evt = chan[0]
-        meta = json.loads(chan_evt.content)
+    fetch = limit + 1
+    while True:
+        evts = await relay.query([{**base, "limit": fetch}])
+        older = sorted(filter(in_range, evts), key=event_key, reverse=True)
+        if len(evts) < fetch:
+            break
+        # the relay cut the result somewhere inside its oldest second, only newer events are complete
+        oldest = min(evt.created_at_ticks for evt in evts)
+        older = [evt for evt in older if evt.created_at_ticks > oldest]
+        if len(older) > limit:
+            break
+        fetch *= 2
 
-        print(f"Event {chan_evt}")
+    page = older[:limit]
+    next_cursor = encode_cursor(*event_key(page[-1])) if len(older) > limit else None
+    page.reverse()
+    return page, next_cursor
 
-        chat = Chat(
-            creator=chan_evt.pub_key,
-            name=meta.get("name", ""),
-            description=meta.get("about", ""),
-            channel_id=channel_id
-        )
+def _chat_from_state(state: "ChatState") -> "Chat":
+    chat = Chat(
+        creator=state.creator,
+        name=state.name,
+        description=state.about,
+        channel_id=state.channel_id
+    )
+    chat.members = list(state.members)
+    chat.amount_of_members = len(chat.members)
+    chat.last_msg_at = state.last_activity
+    return chat
+
+@timed("get_chat")
+async def get_chat(channel_id: str, limit: int = HISTORY_PAGE_SIZE,
+                   before: Optional[str] = None, after: Optional[str] = None):
+    """Loads a chat with one page of its messages, from the chat view when it can answer, else from the relay."""
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    view = get_chat_view()
+    state = view.get(channel_id) if view else None
+    if state is not None:
+        chat = _chat_from_state(state)
+        page = state.page(limit, decode_cursor(before), decode_cursor(after))
+        if page is None:
+            # older than what the view keeps in memory
+            notes, chat.next_cursor = await get_message_page(channel_id, limit, before, after)
+        else:
+            notes, chat.next_cursor = page
+        chat.messages = [Message.from_event(m, channel_id) for m in notes]
+        chat.amount_of_messages = (await get_message_counts([channel_id]))[channel_id]
+        return chat
 
-        # 2. fetch messages
-        notes = await client.query([{
+    relay = await get_relay()
+
+    # 1. fetch the channel-create event
+    chan = await relay.query([{
+        "kinds": [Event.KIND_CHANNEL_CREATE],
+        "ids":   [channel_id]
+    }])
+
+    print(f"Chan: {chan}")
+
+    if not chan:
+        return None
+    chan_evt = chan[0]
+
+    print(f"Event {chan_evt}")
+
+    # 2. fetch the metadata updates and the join/leave events, folded the same way the view does
+    state = ChatState(channel_id, limit)
+    state.apply_create(chan_evt)
+    updates = await relay.query([{
+        "kinds": [Event.KIND_CHANNEL_META] + MEMBERSHIP_KINDS,
+        "#e": [channel_id]
+    }])
+    for evt in sorted(updates, key=event_key):
+        if evt.kind == Event.KIND_CHANNEL_META:
+            state.apply_meta(evt)
+        else:
+            state.apply_membership(evt)
+    chat = _chat_from_state(state)
+
+    # 3. fetch a page of messages
+    notes, chat.next_cursor = await get_message_page(channel_id, limit, before, after)
+    chat.messages = [Message.from_event(m, channel_id) for m in notes]
+    chat.amount_of_messages = (await get_message_counts([channel_id]))[channel_id]
+    if notes:
+        chat.last_msg_at = notes[-1].created_at_ticks
+
+    return chat
+
+@timed("get_last_messages")
+async def get_last_messages(channel_ids: list[str]) -> dict[str, "Message"]:
+    """Returns the newest message of each of the given channels, using at most a single relay query."""
+    newest: dict[str, Event] = {}
+
+    # chats the view knows about don't need the relay at all
+    view = get_chat_view()
+    missing = []
+    for channel_id in channel_ids:
+        state = view.get(channel_id) if view else None
+        if state is None:
+            missing.append(channel_id)
+        elif state.last_message is not None:
+            newest[channel_id] = state.last_message
+
+    if missing:
+        relay = await get_relay()
+
+        # one filter per channel so the relay applies the limit to each channel on its own
+        notes = await relay.query([{
             "kinds": [Event.KIND_CHANNEL_MESSAGE],
-            "#e":   [channel_id]
-        }])
-        chat.messages = [Message(m.pub_key, m.content, channel_id) for m in notes]
-        chat.amount_of_messages = len(chat.messages)
+            "#e": [channel_id],
+            "limit": 1
+        } for channel_id in missing])
 
-        # 3. fetch channel metadata to get members
-        metadata = await client.query([{
-            "kinds": [Event.KIND_CHANNEL_META],
-            "#e": [channel_id]
-        }])
+        wanted = set(missing)
+        for note in notes:
+            for channel_id in note.e_tags:
+                if channel_id in wanted and (channel_id not in newest or event_key(note) > event_key(newest[channel_id])):
+                    newest[channel_id] = note
 
-        # Add all unique pubkeys from messages and metadata as members
-        members = set()
-        for msg in notes:
-            members.add(msg.pub_key)
-        for meta in metadata:
-            members.add(meta.pub_key)
+    return {channel_id: Message.from_event(note, channel_id) for channel_id, note in newest.items()}
 
-        # For now, we'll just use the pubkeys as member IDs since we don't have a UUID mapping
-        chat.members = list(members)
-        chat.amount_of_members = len(chat.members)
+@timed("get_existing_chats")
+async def get_existing_chats(channel_ids: list[str]) -> set[str]:
+    """Which of the given chats exist, the view answers for the ones it knows, one relay query for the rest."""
+    existing = set()
+    view = get_chat_view()
+    missing = []
+    for channel_id in set(channel_ids):
+        if view and view.get(channel_id) is not None:
+            existing.add(channel_id)
+        else:
+            missing.append(channel_id)
 
-        return chat
+    if missing:
+        relay = await get_relay()
+        channel_events = await relay.query([{
+            "kinds": [Event.KIND_CHANNEL_CREATE],
+            "ids": missing
+        }])
+        existing.update(evt.id for evt in channel_events)
+    return existing
 
 async def get_all_chats():
     """Returns a list of all chat IDs that have been created."""
-    async with Client(nostr_url) as client:
-        await client.wait_connect()
+    view = get_chat_view()
+    states = view.chats() if view else None
+    if states is not None:
+        return [state.channel_id for state in states]
 
-        # Query for all channel creation events (kind 40)
-        channel_events = await client.query([{
-            "kinds": [Event.KIND_CHANNEL_CREATE]
-        }])
+    relay = await get_relay()
+
+    # Query for all channel creation events (kind 40)
+    channel_events = await relay.query([{
+        "kinds": [Event.KIND_CHANNEL_CREATE]
+    }])
+
+    # Extract the event IDs (which are the channel IDs)
+    chat_ids = [evt.id for evt in channel_events]
+    return chat_ids
+
+@timed("get_chat_directory")
+async def get_chat_directory(limit: int = CHATS_PAGE_SIZE, before: Optional[str] = None) -> tuple[list["ChatSummary"], Optional[str]]:
+    """Returns a page of chat summaries, most recently active first, and the cursor of the next page."""
+    limit = max(1, min(limit, CHATS_MAX_PAGE_SIZE))
+    before_key = decode_cursor(before)
+
+    view = get_chat_view()
+    page = view.directory(limit, before_key) if view else None
+    if page is not None:
+        states, next_cursor = page
+        counts = await get_message_counts([state.channel_id for state in states])
+        return [ChatSummary(state, counts[state.channel_id]) for state in states], next_cursor
+
+    # without the view only the channel-create events are at hand, so newest chats first and no members
+    relay = await get_relay()
+    the_filter = {"kinds": [Event.KIND_CHANNEL_CREATE]}
+    if before_key:
+        the_filter["until"] = before_key[0]
+    channel_events = await relay.query([the_filter])
+    newest = sorted((evt for evt in channel_events if before_key is None or event_key(evt) < before_key),
+                    key=event_key, reverse=True)
 
-        # Extract the event IDs (which are the channel IDs)
-        chat_ids = [evt.id for evt in channel_events]
-        return chat_ids
\ No newline at end of file
+    counts = await get_message_counts([evt.id for evt in newest[:limit]])
+    summaries = []
+    for evt in newest[:limit]:
+        state = ChatState(evt.id, 0)
+        state.apply_create(evt)
+        summaries.append(ChatSummary(state, counts[evt.id]))
+    next_cursor = encode_cursor(*event_key(newest[limit - 1])) if len(newest) > limit else None
+    return summaries, next_cursor
@@ -0,0 +1,44 @@
+import asyncio
+from v1.config.database import get_database
+from utils.metrics import timed
+
+# Messages per chat, kept in MongoDB as {"chat_id": ..., "messages": n}.
+# n only ever goes up: it counts what was sent, not what the relay still holds, so read cursors
+# (sequence numbers against it) stay valid across restarts and relay retention.
+
+@timed("add_message_counts")
+async def add_message_counts(sent: dict[str, int]):
+    """Counts messages the relay accepted, chat id -> how many were sent to it."""
+    db = await get_database()
+    await asyncio.gather(*[db.chat_counters.update_one(
+        {"chat_id": chat_id},
+        {"$inc": {"messages": amount}},
+        upsert=True
+    ) for chat_id, amount in sent.items() if amount > 0])
+
+@timed("get_message_counts")
+async def get_message_counts(channel_ids: list[str]) -> dict[str, int]:
+    """The number of messages of each chat, the sequence number of its newest message.
+    Chats nothing was counted for yet have 0."""
+    counts = {channel_id: 0 for channel_id in channel_ids}
+    if not counts:
+        return counts
+    db = await get_database()
+    async for doc in db.chat_counters.find({"chat_id": {"$in": list(counts)}}, {"chat_id": 1, "messages": 1}):
+        counts[doc["chat_id"]] = doc.get("messages", 0)
+    return counts
+
+@timed("seed_message_counts")
+async def seed_message_counts(known: dict[str, int]):
+    """Raises counters to at least the number of messages known to be in each chat.
+    Chats from before the counters existed start from what the relay holds, the rest are left alone."""
+    counts = await get_message_counts(list(known))
+    behind = {channel_id: amount for channel_id, amount in known.items() if amount > counts[channel_id]}
+    if not behind:
+        return
+    db = await get_database()
+    await asyncio.gather(*[db.chat_counters.update_one(
+        {"chat_id": chat_id},
+        {"$max": {"messages": amount}},
+        upsert=True
+    ) for chat_id, amount in behind.items()])
@@ -0,0 +1,258 @@
+import os
+import fcntl
+import asyncio
+import logging
+from typing import Optional
+import aiosqlite
+from monstr.event.event import Event
+from v1.config.relay import get_relay
+from v1.processors.chat_view import get_chat_view
+from utils.nostr import channel_of
+
+# Where the search index lives, on the persistent volume so it isn't rebuilt from the relay on every start.
+# The API workers share it, one of them writes it (see ChatSearch). ":memory:" gives every worker its own
+SEARCH_DB_PATH = os.getenv("SEARCH_DB_PATH", "/data/search.db")
+# How often (seconds) the other workers check if the one writing the index is gone
+SEARCH_LOCK_RETRY = 5
+# Default and maximum amount of results per search page
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+# Messages written to the index per transaction, and fetched from the relay per query when catching up
+SEARCH_BATCH_SIZE = 500
+
+CREATE_SQL = [
+    """
+    create table if not exists messages(
+        id integer primary key,
+        event_id text not null unique,
+        channel_id text not null,
+        pubkey text not null,
+        created_at integer not null,
+        content text not null
+    )
+    """,
+    # the inverted index, it points at the messages rows instead of keeping its own copy of the text
+    "create virtual table if not exists messages_fts using fts5(content, content='messages', content_rowid='id')",
+    """
+    create trigger if not exists messages_index after insert on messages begin
+        insert into messages_fts(rowid, content) values (new.id, new.content);
+    end
+    """,
+]
+
+
+def match_query(text: str) -> Optional[str]:
+    """Turns what the user typed into an FTS5 query that matches messages containing all the words.
+    Every word is quoted so FTS5 operators and punctuation in it are taken literally."""
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words)
+
+
+class ChatSearch:
+    """Full text index over the messages of all chats, kept in SQLite FTS5.
+    New messages come from the chat view, so it follows the same relay subscription.
+    On start the stored messages are walked back from the relay a batch at a time (`catching_up`).
+
+    With several API workers on one file only the worker holding the lock next to it writes the index
+    (`writing`), the others search it as it is. When the writing worker goes away another one takes over.
+    """
+    def __init__(self, db_path: str = SEARCH_DB_PATH):
+        self._db_path = db_path
+        self._db: Optional[aiosqlite.Connection] = None
+        # (channel id, event) waiting to be written, the view's listeners can't wait for the database
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._writer: Optional[asyncio.Task] = None
+        self._catch_up: Optional[asyncio.Task] = None
+        self._waiting: Optional[asyncio.Task] = None
+        # open while this process is the one writing the index
+        self._lock = None
+        self.indexed = 0
+
+    async def start(self):
+        if self._db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self._db_path)), exist_ok=True)
+        # listen before the first await, the view may get its stored events any moment now
+        if self._take_lock():
+            self._listen()
+        self._db = await aiosqlite.connect(self._db_path)
+        await self._db.execute("pragma journal_mode=wal")
+        await self._db.execute("pragma synchronous=normal")
+        for sql in CREATE_SQL:
+            await self._db.execute(sql)
+        await self._db.commit()
+        if self.writing:
+            self._start_writing()
+        else:
+            self._waiting = asyncio.create_task(self._wait_for_lock())
+        logging.info(f"ChatSearch::start {self._db_path} writing={self.writing}")
+
+    async def stop(self):
+        view = get_chat_view()
+        if view:
+            view.remove_listener(self.on_message)
+        for task in (self._waiting, self._catch_up, self._writer):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._waiting = self._catch_up = self._writer = None
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+        if self._lock is not None:
+            # closing the file lets another worker take over
+            self._lock.close()
+            self._lock = None
+
+    @property
+    def writing(self) -> bool:
+        return self._db_path == ":memory:" or self._lock is not None
+
+    def _take_lock(self) -> bool:
+        """Makes this process the one writing the index, False if another process already is."""
+        if self.writing:
+            return True
+        lock = open(f"{self._db_path}.lock", "w")
+        try:
+            # the lock goes away with the process, however it ends
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        self._lock = lock
+        return True
+
+    def _listen(self):
+        view = get_chat_view()
+        if view:
+            view.add_listener(self.on_message)
+
+    def _start_writing(self):
+        self._writer = asyncio.create_task(self._write())
+        self._catch_up = asyncio.create_task(self._walk_back())
+
+    async def _wait_for_lock(self):
+        while not self._take_lock():
+            await asyncio.sleep(SEARCH_LOCK_RETRY)
+        logging.info(f"ChatSearch::_wait_for_lock writing {self._db_path}")
+        # what was sent while no one was writing is newer than the index, the walk back picks it up
+        self._listen()
+        self._start_writing()
+
+    def on_message(self, channel_id: str, evt: Event):
+        self._queue.put_nowait((channel_id, evt))
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def catching_up(self) -> bool:
+        return self._catch_up is not None and not self._catch_up.done()
+
+    async def _insert(self, batch: list[tuple[str, Event]]):
+        try:
+            # messages that are already indexed are skipped, the trigger indexes the rest
+            await self._db.executemany(
+                "insert or ignore into messages(event_id, channel_id, pubkey, created_at, content) values(?,?,?,?,?)",
+                [(evt.id, channel_id, evt.pub_key, evt.created_at_ticks, evt.content) for channel_id, evt in batch])
+            await self._db.commit()
+            self.indexed += len(batch)
+        except aiosqlite.Error as e:
+            logging.warning(f"ChatSearch::_insert {e}")
+
+    async def _write(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty() and len(batch) < SEARCH_BATCH_SIZE:
+                batch.append(self._queue.get_nowait())
+            await self._insert(batch)
+
+    async def _walk_back(self):
+        """Indexes the stored messages newest first, SEARCH_BATCH_SIZE per relay query, so only one batch
+        is in memory at a time. It stops at the newest message an index kept on disk already has."""
+        cursor = await self._db.execute("select max(created_at) from messages")
+        (indexed_until,) = await cursor.fetchone()
+        relay = await get_relay()
+        # newest second still to be indexed, since/until are inclusive (NIP-01).
+        # Messages asked for twice are skipped by the insert
+        until = None
+        while True:
+            the_filter = {"kinds": [Event.KIND_CHANNEL_MESSAGE], "limit": SEARCH_BATCH_SIZE}
+            if until is not None:
+                the_filter["until"] = until
+            try:
+                evts = await relay.query([the_filter])
+                full = len(evts) >= SEARCH_BATCH_SIZE
+                oldest = min((evt.created_at_ticks for evt in evts), default=0)
+                # the limit may have cut the oldest second, so it is asked for again
+                next_until = oldest
+                if full and oldest == until:
+                    # a single second holds more than a batch and a limit can't page within it,
+                    # so that second is fetched whole and the walk goes on before it
+                    evts = await relay.query([{"kinds": [Event.KIND_CHANNEL_MESSAGE], "since": oldest, "until": oldest}])
+                    next_until = oldest - 1
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                logging.warning(f"ChatSearch::_walk_back {e}")
+                return
+            batch = [(channel_of(evt), evt) for evt in evts]
+            await self._insert([(channel_id, evt) for channel_id, evt in batch if channel_id is not None])
+            if not full or (indexed_until is not None and next_until < indexed_until):
+                return
+            until = next_until
+
+    async def search(self, channel_ids: list[str], text: str, limit: int = SEARCH_PAGE_SIZE,
+                     offset: int = 0) -> tuple[list[dict], Optional[int]]:
+        """Messages of the given chats that contain all words of text, best match (bm25) first.
+        Returns a page of messages and the offset of the next page (None on the last one)."""
+        query = match_query(text)
+        if not query or not channel_ids:
+            return [], None
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+        offset = max(0, offset)
+
+        # the match is answered by the index, the chat filter then only looks at the matching rows
+        placeholders = ",".join("?" * len(channel_ids))
+        cursor = await self._db.execute(
+            f"""
+            select m.event_id, m.channel_id, m.pubkey, m.created_at, m.content
+            from messages_fts join messages m on m.id = messages_fts.rowid
+            where messages_fts match ? and m.channel_id in ({placeholders})
+            order by bm25(messages_fts), m.created_at desc
+            limit ? offset ?
+            """,
+            [query, *channel_ids, limit + 1, offset])
+        rows = await cursor.fetchall()
+        next_offset = offset + limit if len(rows) > limit else None
+
+        results = [{
+            "uuid": event_id,
+            "sender": pubkey,
+            "message": content,
+            "sent_at": created_at,
+            "chat_id": channel_id
+        } for event_id, channel_id, pubkey, created_at, content in rows[:limit]]
+        return results, next_offset
+
+
+# Global search instance
+_search: Optional[ChatSearch] = None
+
+def get_chat_search() -> Optional[ChatSearch]:
+    return _search
+
+async def start_chat_search():
+    global _search
+    if _search is None:
+        _search = ChatSearch()
+        await _search.start()
+
+async def stop_chat_search():
+    global _search
+    if _search is not None:
+        await _search.stop()
+        _search = None
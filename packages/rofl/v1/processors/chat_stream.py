@@ -0,0 +1,116 @@
+import os
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+from monstr.event.event import Event
+from v1.processors.chat_view import get_chat_view
+from utils.nostr import event_key
+from utils.cursor import encode_cursor, decode_cursor
+
+# Messages buffered per connected client, a client that falls further behind loses the oldest ones
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "256"))
+# Seconds between keep-alive comments so proxies don't close idle streams
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))
+# Most messages replayed per chat when a client reconnects with Last-Event-ID
+STREAM_REPLAY_SIZE = 100
+
+
+def message_data(channel_id: str, evt: Event) -> dict:
+    return {
+        "uuid": evt.id,
+        "sender": evt.pub_key,
+        "message": evt.content,
+        "sent_at": evt.created_at_ticks,
+        "chat_id": channel_id
+    }
+
+def sse_message(channel_id: str, evt: Event) -> str:
+    # the id is a history cursor, browsers send it back as Last-Event-ID when they reconnect
+    return f"id: {encode_cursor(*event_key(evt))}\nevent: message\ndata: {json.dumps(message_data(channel_id, evt))}\n\n"
+
+
+class ChatBroker:
+    """Fans the messages the chat view receives out to the connected stream clients.
+    All clients share the view's single relay subscription, each one gets its own queue."""
+    def __init__(self, queue_size: int = STREAM_QUEUE_SIZE):
+        self._queue_size = queue_size
+        # channel id -> queues of the clients following it
+        self._subscribers: dict[str, set[asyncio.Queue]] = {}
+
+    @property
+    def clients(self) -> int:
+        return len({queue for queues in self._subscribers.values() for queue in queues})
+
+    def subscribe(self, channel_ids: list[str]) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        for channel_id in channel_ids:
+            self._subscribers.setdefault(channel_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, channel_ids: list[str]):
+        for channel_id in channel_ids:
+            queues = self._subscribers.get(channel_id)
+            if queues is None:
+                continue
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[channel_id]
+
+    def on_message(self, channel_id: str, evt: Event):
+        for queue in self._subscribers.get(channel_id, ()):
+            if queue.full():
+                # slow client, drop its oldest message rather than holding up everyone else
+                queue.get_nowait()
+            queue.put_nowait((channel_id, evt))
+
+    async def stream(self, channel_ids: list[str], last_event_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Server-sent events with the new messages of the given chats, until the client goes away."""
+        queue = self.subscribe(channel_ids)
+        try:
+            # what was missed since the last event the client got, as far as the view still has it
+            after_key = decode_cursor(last_event_id)
+            if after_key is not None:
+                view = get_chat_view()
+                missed = []
+                for channel_id in channel_ids:
+                    state = view.get(channel_id) if view else None
+                    page = state.page(STREAM_REPLAY_SIZE, after_key=after_key) if state else None
+                    if page is not None:
+                        missed.extend((channel_id, evt) for evt in page[0])
+                for channel_id, evt in sorted(missed, key=lambda m: event_key(m[1])):
+                    yield sse_message(channel_id, evt)
+
+            while True:
+                try:
+                    channel_id, evt = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield sse_message(channel_id, evt)
+        finally:
+            self.unsubscribe(queue, channel_ids)
+
+
+# Global broker instance
+_broker: Optional[ChatBroker] = None
+
+def get_chat_broker() -> Optional[ChatBroker]:
+    """The running broker, None when the chat view isn't running so there is nothing to stream."""
+    return _broker
+
+async def start_chat_broker():
+    global _broker
+    view = get_chat_view()
+    if _broker is None and view is not None:
+        _broker = ChatBroker()
+        view.add_listener(_broker.on_message)
+        logging.info("ChatBroker started")
+
+async def stop_chat_broker():
+    global _broker
+    if _broker is not None:
+        view = get_chat_view()
+        if view is not None:
+            view.remove_listener(_broker.on_message)
+        _broker = None
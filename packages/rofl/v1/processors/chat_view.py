@@ -0,0 +1,410 @@
+import os
+import json
+import time
+import bisect
+import asyncio
+import logging
+from collections import Counter
+from typing import Callable, Optional
+from monstr.client.client import Client
+from monstr.event.event import Event
+from pymongo.errors import PyMongoError
+from v1.config.relay import get_relay
+from v1.processors.chat_counts import seed_message_counts, get_message_counts
+from utils.cursor import encode_cursor
+from utils.nostr import event_key, channel_of
+
+# Amount of recent messages kept in memory per chat, should be at least a history page
+CHAT_VIEW_TAIL_SIZE = int(os.getenv("CHAT_VIEW_TAIL_SIZE", "100"))
+# Chats whose tails are loaded per relay query on start, a query returns at most this many tails
+CHAT_VIEW_BACKFILL_CHATS = int(os.getenv("CHAT_VIEW_BACKFILL_CHATS", "50"))
+# Messages per relay query when counting the history of a chat that has no message counter yet
+CHAT_VIEW_COUNT_BATCH = 500
+
+# Signed membership events, tagged ["e", <channel id>]. The newest one of a pubkey decides if it is a member.
+# No NIP assigns these kinds, NIP-29 uses 9021/9022 for group join/leave requests with an "h" tag
+KIND_CHANNEL_JOIN = 4240
+KIND_CHANNEL_LEAVE = 4241
+MEMBERSHIP_KINDS = [KIND_CHANNEL_JOIN, KIND_CHANNEL_LEAVE]
+
+# Kinds the view loads in full, there are a few per chat and member. Messages are only loaded as tails
+META_KINDS = [Event.KIND_CHANNEL_CREATE, Event.KIND_CHANNEL_META] + MEMBERSHIP_KINDS
+
+
+class ChatState:
+    """Everything the API needs to know about a chat, kept up to date from the relay subscription."""
+    def __init__(self, channel_id: str, tail_size: int):
+        self.channel_id = channel_id
+        # None until the channel-create event has been seen
+        self.creator: Optional[str] = None
+        self.created_at = 0
+        self.name = ""
+        self.about = ""
+        self.picture = ""
+        self._meta_at = 0
+        self.members: set[str] = set()
+        # pubkey -> key of its newest join/leave event
+        self._membership: dict[str, tuple[int, str]] = {}
+        # newest messages, oldest first
+        self.tail: list[Event] = []
+        self._tail_ids: set[str] = set()
+        self._tail_size = tail_size
+        # True while the tail holds every message of the chat, from its first one
+        self.complete = True
+
+    @property
+    def exists(self) -> bool:
+        return self.creator is not None
+
+    @property
+    def last_message(self) -> Optional[Event]:
+        return self.tail[-1] if self.tail else None
+
+    @property
+    def last_activity(self) -> int:
+        return self.tail[-1].created_at_ticks if self.tail else self.created_at
+
+    def apply_create(self, evt: Event):
+        try:
+            meta = json.loads(evt.content)
+        except json.JSONDecodeError:
+            meta = {}
+        self.creator = evt.pub_key
+        self.created_at = evt.created_at_ticks
+        self.name = meta.get("name", "")
+        self.about = meta.get("about", "")
+        self.picture = meta.get("picture", "")
+
+    def apply_meta(self, evt: Event):
+        # NIP-28 metadata updates only count when they come from the creator
+        if evt.pub_key != self.creator or evt.created_at_ticks < self._meta_at:
+            return
+        try:
+            meta = json.loads(evt.content)
+        except json.JSONDecodeError:
+            return
+        self._meta_at = evt.created_at_ticks
+        self.name = meta.get("name", self.name)
+        self.about = meta.get("about", self.about)
+        self.picture = meta.get("picture", self.picture)
+
+    def membership_at(self, pubkey: str) -> int:
+        """created_at of the newest join/leave event of a pubkey, 0 if it has none."""
+        known = self._membership.get(pubkey)
+        return known[0] if known else 0
+
+    def apply_membership(self, evt: Event) -> bool:
+        """Applies a join/leave event, returns False if a newer one of that pubkey is already known."""
+        key = event_key(evt)
+        known = self._membership.get(evt.pub_key)
+        if known is not None and known >= key:
+            return False
+        self._membership[evt.pub_key] = key
+        if evt.kind == KIND_CHANNEL_JOIN:
+            self.members.add(evt.pub_key)
+        else:
+            self.members.discard(evt.pub_key)
+        return True
+
+    def apply_message(self, evt: Event) -> bool:
+        """Adds a message, returns False if it was already known."""
+        if evt.id in self._tail_ids:
+            return False
+
+        # messages mostly arrive in order, so this is nearly always an append
+        key = event_key(evt)
+        if self.tail and key < event_key(self.tail[-1]):
+            pos = bisect.bisect([event_key(m) for m in self.tail], key)
+            if pos == 0 and len(self.tail) >= self._tail_size:
+                # older than all we keep, so there's more history than the tail
+                self.complete = False
+                return True
+            self.tail.insert(pos, evt)
+        else:
+            self.tail.append(evt)
+        self._tail_ids.add(evt.id)
+
+        if len(self.tail) > self._tail_size:
+            dropped = self.tail.pop(0)
+            self._tail_ids.discard(dropped.id)
+            self.complete = False
+        return True
+
+    def page(self, limit: int, before_key: Optional[tuple[int, str]] = None,
+             after_key: Optional[tuple[int, str]] = None) -> Optional[tuple[list[Event], Optional[str]]]:
+        """A page of messages served from the tail, same semantics as chat.get_message_page.
+        Returns None when the tail doesn't hold enough of the history to answer."""
+        def in_range(evt: Event) -> bool:
+            key = event_key(evt)
+            return (before_key is None or key < before_key) and (after_key is None or key > after_key)
+
+        if after_key is not None:
+            if not self.complete and (not self.tail or after_key < event_key(self.tail[0])):
+                return None
+            newer = [evt for evt in self.tail if in_range(evt)]
+            page = newer[:limit]
+            return page, encode_cursor(*event_key(page[-1])) if len(newer) > limit else None
+
+        older = [evt for evt in self.tail if in_range(evt)]
+        if len(older) > limit:
+            page = older[-limit:]
+            return page, encode_cursor(*event_key(page[0]))
+        if self.complete:
+            return older, None
+        return None
+
+
+class ChatView:
+    """In memory index of all chats, fed by one subscription to the relay for kinds 40/41/42 and join/leave.
+    The subscription asks for every stored 40/41/join/leave but only for messages from now on,
+    the stored messages are loaded as a tail per chat. Reads only use the view once that is done (`ready`),
+    until then and for chats it doesn't know yet they go to the relay.
+    """
+    def __init__(self, tail_size: int = CHAT_VIEW_TAIL_SIZE):
+        self._tail_size = tail_size
+        self._chats: dict[str, ChatState] = {}
+        self._sub_id: Optional[str] = None
+        # created_at of the newest event seen, used as since when resubscribing
+        self._newest = 0
+        # when the subscription was first sent, older messages come from the tails
+        self._started = 0
+        self.ready = asyncio.Event()
+        # (last activity, channel id) of every existing chat, least recently active first
+        self._by_activity: list[tuple[int, str]] = []
+        self._activity: dict[str, int] = {}
+        # called with every new message the view hasn't seen before, the loaded tails aren't passed on
+        self._listeners: list[Callable[[str, Event], None]] = []
+        self._loading: Optional[asyncio.Future] = None
+
+    async def start(self):
+        relay = await get_relay()
+        self._started = int(time.time())
+        self._sub_id = await relay.subscribe(filters=self._filters,
+                                             handler=self._on_event,
+                                             eose_func=self._on_eose)
+
+    async def stop(self):
+        if self._sub_id is not None:
+            relay = await get_relay()
+            relay.unsubscribe(self._sub_id)
+            self._sub_id = None
+        if self._loading is not None:
+            self._loading.cancel()
+            try:
+                await self._loading
+            except asyncio.CancelledError:
+                pass
+            self._loading = None
+
+    def add_listener(self, listener: Callable[[str, Event], None]):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str, Event], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _filters(self) -> list[dict]:
+        meta_filter = {"kinds": META_KINDS}
+        message_filter = {"kinds": [Event.KIND_CHANNEL_MESSAGE], "since": self._started}
+        # after a reconnect only ask for what we may have missed, since is inclusive so the newest second is asked again
+        if self._newest:
+            meta_filter["since"] = self._newest
+            message_filter["since"] = max(self._started, self._newest)
+        return [meta_filter, message_filter]
+
+    def _on_eose(self, the_client: Client, sub_id: str, events: list[Event]):
+        # stored events come newest first, apply them in the order they were created
+        for evt in sorted(events, key=event_key):
+            self.apply(evt)
+        if self._loading is None:
+            logging.info(f"ChatView loaded {len(self._chats)} chats from {len(events)} events")
+            self._loading = asyncio.ensure_future(self._load_tails())
+
+    async def _load_tails(self):
+        """Loads the newest messages of every known chat, CHAT_VIEW_BACKFILL_CHATS chats per relay query.
+        No more than a tail per chat is fetched however long its history is, then the view is `ready`."""
+        relay = await get_relay()
+        channel_ids = [state.channel_id for state in self._chats.values() if state.exists]
+        loaded = 0
+        # chats with more history than a tail, they are counted on the relay once the view is ready
+        uncounted = []
+        for start in range(0, len(channel_ids), CHAT_VIEW_BACKFILL_CHATS):
+            chunk = channel_ids[start:start + CHAT_VIEW_BACKFILL_CHATS]
+            stored: Counter = Counter()
+            # chats whose whole history was in the tail, their counters start from it
+            counted = {}
+            try:
+                # one filter per chat so the relay applies the limit to each chat on its own
+                evts = await relay.query([{
+                    "kinds": [Event.KIND_CHANNEL_MESSAGE],
+                    "#e": [channel_id],
+                    "limit": self._tail_size
+                } for channel_id in chunk])
+            except (asyncio.TimeoutError, ConnectionError) as e:
+                logging.warning(f"ChatView::_load_tails {e}")
+                evts = None
+            for evt in sorted(evts or [], key=event_key):
+                channel_id = channel_of(evt)
+                stored[channel_id] += 1
+                # these aren't new, listeners only hear about messages sent from now on
+                self.apply(evt, notify=False)
+            for channel_id in chunk:
+                # with a full tail (or none at all) there may be older messages, pages before it go to the relay
+                if evts is None or stored[channel_id] >= self._tail_size:
+                    self._chats[channel_id].complete = False
+                    uncounted.append(channel_id)
+                else:
+                    counted[channel_id] = stored[channel_id]
+            loaded += sum(stored.values())
+            await self._seed_counts(counted)
+
+        logging.info(f"ChatView loaded {loaded} messages of {len(channel_ids)} chats")
+        self.ready.set()
+
+        # a counter no higher than a tail is behind the relay for these, it is missing or only has what
+        # was sent since the start. Those start from what the relay holds, the others are left alone
+        try:
+            counts = await get_message_counts(uncounted)
+        except PyMongoError as e:
+            logging.warning(f"ChatView::_load_tails {e}")
+            return
+        for channel_id in uncounted:
+            if counts[channel_id] <= self._tail_size:
+                total = await self._count_messages(relay, channel_id)
+                if total is not None:
+                    await self._seed_counts({channel_id: total})
+
+    @staticmethod
+    async def _seed_counts(known: dict[str, int]):
+        if not known:
+            return
+        try:
+            await seed_message_counts(known)
+        except PyMongoError as e:
+            logging.warning(f"ChatView::_seed_counts {e}")
+
+    @staticmethod
+    async def _count_messages(relay, channel_id: str) -> Optional[int]:
+        """Counts the messages the relay holds for a chat, walking back CHAT_VIEW_COUNT_BATCH at a time.
+        None if the relay couldn't be asked."""
+        base = {"kinds": [Event.KIND_CHANNEL_MESSAGE], "#e": [channel_id]}
+        total = 0
+        until = None
+        try:
+            while True:
+                the_filter = {**base, "limit": CHAT_VIEW_COUNT_BATCH}
+                if until is not None:
+                    the_filter["until"] = until
+                evts = await relay.query([the_filter])
+                if len(evts) < CHAT_VIEW_COUNT_BATCH:
+                    return total + len(evts)
+                oldest = min(evt.created_at_ticks for evt in evts)
+                if oldest == until:
+                    # a single second holds more than a batch, a limit can't page within it so it is fetched whole
+                    total += len(await relay.query([{**base, "since": oldest, "until": oldest}]))
+                    until = oldest - 1
+                else:
+                    # the limit may have cut the oldest second, it is counted with the next batch
+                    total += sum(1 for evt in evts if evt.created_at_ticks > oldest)
+                    until = oldest
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logging.warning(f"ChatView::_count_messages {e}")
+            return None
+
+    def _on_event(self, the_client: Client, sub_id: str, evt: Event):
+        self.apply(evt)
+
+    def _state(self, channel_id: str) -> ChatState:
+        state = self._chats.get(channel_id)
+        if state is None:
+            state = self._chats[channel_id] = ChatState(channel_id, self._tail_size)
+        return state
+
+    def _update_activity(self, state: ChatState):
+        """Keeps the chat's place in the activity index in line with its last activity."""
+        if not state.exists:
+            return
+        last_activity = state.last_activity
+        known = self._activity.get(state.channel_id)
+        if known == last_activity:
+            return
+        if known is not None:
+            pos = bisect.bisect_left(self._by_activity, (known, state.channel_id))
+            del self._by_activity[pos]
+        bisect.insort(self._by_activity, (last_activity, state.channel_id))
+        self._activity[state.channel_id] = last_activity
+
+    def apply(self, evt: Event, notify: bool = True) -> bool:
+        """Updates the view with an event, returns False if it was ignored or already known.
+        New messages are passed on to the listeners unless notify is False."""
+        self._newest = max(self._newest, evt.created_at_ticks)
+        if evt.kind == Event.KIND_CHANNEL_CREATE:
+            state = self._state(evt.id)
+            state.apply_create(evt)
+            self._update_activity(state)
+            return True
+
+        channel_id = channel_of(evt)
+        if channel_id is None:
+            return False
+        if evt.kind == Event.KIND_CHANNEL_META:
+            self._state(channel_id).apply_meta(evt)
+            return True
+        if evt.kind == Event.KIND_CHANNEL_MESSAGE:
+            state = self._state(channel_id)
+            if not state.apply_message(evt):
+                return False
+            self._update_activity(state)
+            if notify:
+                for listener in self._listeners:
+                    listener(channel_id, evt)
+            return True
+        if evt.kind in MEMBERSHIP_KINDS:
+            return self._state(channel_id).apply_membership(evt)
+        return False
+
+    def get(self, channel_id: str) -> Optional[ChatState]:
+        """The state of a chat, or None if the view can't answer for it (yet)."""
+        if not self.ready.is_set():
+            return None
+        state = self._chats.get(channel_id)
+        if state is None or not state.exists:
+            return None
+        return state
+
+    def chats(self) -> Optional[list[ChatState]]:
+        """All known chats, or None while the view is still loading."""
+        if not self.ready.is_set():
+            return None
+        return [state for state in self._chats.values() if state.exists]
+
+    def directory(self, limit: int, before_key: Optional[tuple[int, str]] = None) -> Optional[tuple[list[ChatState], Optional[str]]]:
+        """A page of chats, most recently active first, and the cursor of the next page.
+        Returns None while the view is still loading."""
+        if not self.ready.is_set():
+            return None
+        end = bisect.bisect_left(self._by_activity, before_key) if before_key else len(self._by_activity)
+        start = max(0, end - limit)
+        page = self._by_activity[start:end][::-1]
+        next_cursor = encode_cursor(*page[-1]) if start > 0 else None
+        return [self._chats[channel_id] for _, channel_id in page], next_cursor
+
+
+# Global view instance
+_view: Optional[ChatView] = None
+
+def get_chat_view() -> Optional[ChatView]:
+    """The running chat view, None when it hasn't been started (reads then go to the relay)."""
+    return _view
+
+async def start_chat_view():
+    global _view
+    if _view is None:
+        _view = ChatView()
+        await _view.start()
+
+async def stop_chat_view():
+    global _view
+    if _view is not None:
+        await _view.stop()
+        _view = None
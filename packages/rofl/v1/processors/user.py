@@ -1,16 +1,87 @@
-from v1.processors.chat import get_chat, Chat, Message
-from utils.rofl_status import RoflStatus
+import os
+import asyncio
+from collections import Counter
+from cachetools import TTLCache
+from v1.processors.chat import (get_chat, get_last_messages, get_existing_chats, message_event, membership_event,
+                                Chat, Message, FeedEntry)
+from v1.processors.chat_view import get_chat_view, KIND_CHANNEL_JOIN
+from v1.processors.chat_counts import add_message_counts, get_message_counts
+from v1.config.relay import get_relay, RelayPublishError
+from v1.processors.cache_sync import on_invalidate, invalidate
+from utils.signing import sign_events
+from utils.rofl_status import RoflStatus, Error
+from utils.metrics import timed
 from monstr.encrypt import Keys
 from typing import Optional
 from v1.models.user_db import UserDB
 from v1.config.database import get_database
 
+# Users kept in memory so repeat requests don't go to MongoDB, least recently used are dropped first
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# Seconds a cached user is trusted before it is read again
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# Most messages accepted by a single batch send
+MESSAGE_BATCH_MAX = int(os.getenv("MESSAGE_BATCH_MAX", "500"))
+
+_user_cache: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_cache_hits = 0
+_cache_misses = 0
+# uuid -> how often the user changed, and how often any user may have. A user read from MongoDB is only
+# cached if it didn't change while the read was on its way, else it would put the old version back
+_changes: dict[str, int] = {}
+_all_changes = 0
+
+def _version(uuid: str) -> tuple[int, int]:
+    return _all_changes, _changes.get(uuid, 0)
+
+def _changed(uuids: Optional[list[str]]):
+    global _all_changes
+    if uuids is None or len(_changes) >= USER_CACHE_SIZE:
+        # counting every user doesn't fit, counting them all as changed at once does
+        _all_changes += 1
+        _changes.clear()
+    for uuid in uuids or []:
+        _changes[uuid] = _changes.get(uuid, 0) + 1
+
+def _invalidate_users(uuids: Optional[list[str]]):
+    """Another worker changed these users (None: any user may have changed)."""
+    _changed(uuids)
+    if uuids is None:
+        _user_cache.clear()
+        return
+    for uuid in uuids:
+        _user_cache.pop(uuid, None)
+
+on_invalidate("user", _invalidate_users)
+
 class User:
-    def __init__(self, display_name: str, uuid: str):
+    def __init__(self, display_name: str, uuid: str, private_key_hex: str, public_key_hex: Optional[str] = None):
         self.display_name = display_name
         self.uuid = uuid
         self.joined_chats: list[str] = []
-        self.nostr_key = Keys()
+        # chat id -> how many of the chat's messages the user has read
+        self.read_cursors: dict[str, int] = {}
+        # events are signed with the hex key directly, Keys (and its curve math) is only built when asked for
+        self._private_key_hex = private_key_hex
+        self._public_key_hex = public_key_hex
+        self._nostr_key: Optional[Keys] = None
+
+    @property
+    def nostr_key(self) -> Keys:
+        if self._nostr_key is None:
+            self._nostr_key = Keys(self._private_key_hex)
+        return self._nostr_key
+
+    @property
+    def private_key_hex(self) -> str:
+        return self._private_key_hex
+
+    @property
+    def public_key_hex(self) -> str:
+        if self._public_key_hex is None:
+            self._public_key_hex = self.nostr_key.public_key_hex()
+        return self._public_key_hex
 
     def to_dict(self):
         return {
@@ -21,7 +92,10 @@ class User:
 
     @classmethod
     async def create(cls, display_name: str, uuid: str) -> "RoflStatus":
-        new_user = cls(display_name=display_name, uuid=uuid)
+        # the only place a new keypair is generated
+        keys = Keys()
+        new_user = cls(display_name=display_name, uuid=uuid,
+                       private_key_hex=keys.private_key_hex(), public_key_hex=keys.public_key_hex())
         await save_user(new_user)
         return RoflStatus.SUCCESS.create(f"Created User {new_user.uuid}", new_user.to_dict())
 
@@ -31,10 +105,19 @@ class User:
         chat = await get_chat(chat_id)
         if not chat:
             return RoflStatus.ERROR.create(f"Chat {chat_id} not found")
-        self.joined_chats.append(chat.uuid)
-        # Save the updated state
-        await save_user(self)
-        return await chat.join_chat(self)
+        joined = await add_joined_chat(self.uuid, chat.uuid)
+        # either way the database now has the chat, keep this (cached) instance in line with it
+        if chat.uuid not in self.joined_chats:
+            self.joined_chats.append(chat.uuid)
+        if not joined:
+            return RoflStatus.ERROR.create(f"User {self.uuid} is already in chat {chat_id}", self.joined_chats)
+        res = await chat.join_chat(self)
+        if isinstance(res, Error):
+            # the relay didn't take the join event, undo it so the user can try again
+            await remove_joined_chat(self.uuid, chat.uuid)
+            if chat.uuid in self.joined_chats:
+                self.joined_chats.remove(chat.uuid)
+        return res
 
     async def leave_chat(self, chat_id: str) -> "RoflStatus":
         if chat_id not in self.joined_chats:
@@ -42,68 +125,231 @@ class User:
         chat = await get_chat(chat_id)
         if not chat:
             return RoflStatus.ERROR.create(f"Chat {chat_id} not found")
-        self.joined_chats.remove(chat.uuid)
-        # Save the updated state
-        await save_user(self)
-        return await chat.leave_chat(self)
+        left = await remove_joined_chat(self.uuid, chat.uuid)
+        if chat.uuid in self.joined_chats:
+            self.joined_chats.remove(chat.uuid)
+        self.read_cursors.pop(chat.uuid, None)
+        if not left:
+            return RoflStatus.ERROR.create(f"User {self.uuid} isn't in chat {chat_id}", self.joined_chats)
+        res = await chat.leave_chat(self)
+        if isinstance(res, Error):
+            # the relay didn't take the leave event, undo it so the user can try again
+            await add_joined_chat(self.uuid, chat.uuid)
+            if chat.uuid not in self.joined_chats:
+                self.joined_chats.append(chat.uuid)
+        return res
 
     async def get_chat_feed(self) -> "RoflStatus":
-        feed: list["Message"] = []
-        for chat_id in self.joined_chats:
-            chat = await get_chat(chat_id)
-            if not chat:
-                continue
-            # Create a list of the chats that this user is in, but only get the last messages
-            match chat.get_last_message():
-                # If nothing is returned from current index, just skip :)
-                case None:
-                    continue
-                # Else we're appending it to our result
-                case entry:
-                    feed.append(entry)
-
-        # Sort it so that we get the recently active chats first
-        feed.sort(key=lambda m: m.sent_at, reverse=True)
+        # Only the last message of every chat this user is in, fetched in one go
+        last_messages = await get_last_messages(self.joined_chats)
+        # unread counts are the chat's message count minus the user's read cursor, no message is looked at
+        counts = await get_message_counts(list(last_messages))
+        feed: list["FeedEntry"] = [FeedEntry(message, counts[chat_id], self.read_cursors.get(chat_id, 0))
+                                   for chat_id, message in last_messages.items()]
+
+        # Sort it so that we get the recently active chats first, sent_at is the event's created_at
+        feed.sort(key=lambda m: (m.sent_at, m.uuid), reverse=True)
 
         # Return the result
         return RoflStatus.SUCCESS.create(f"Chatfeed of {self.uuid}:", feed)
 
+    async def mark_read(self, chat_id: str, seq: Optional[int] = None) -> "RoflStatus":
+        """Moves the user's read cursor of a chat forward to seq, by default to the chat's newest message.
+        Cursors never move back, a stale request can't make read messages unread again."""
+        if chat_id not in self.joined_chats:
+            return RoflStatus.ERROR.create(f"User {self.uuid} is not in this group {chat_id}")
+        message_count = (await get_message_counts([chat_id]))[chat_id]
+        seq = message_count if seq is None else max(0, min(seq, message_count))
+        await set_read_cursor(self.uuid, chat_id, seq)
+        read_seq = self.read_cursors[chat_id] = max(self.read_cursors.get(chat_id, 0), seq)
+        return RoflStatus.SUCCESS.create(f"User {self.uuid} read chat {chat_id} up to {read_seq}", {
+            "chat_id": chat_id,
+            "read_seq": read_seq,
+            "unread": max(0, message_count - read_seq)
+        })
+
     async def create_chat(self, name: str, description: str, image_url: str) -> "RoflStatus":
-        chat: "Chat" = await Chat.create(self, name=name, description=description, image_url=image_url)
+        try:
+            chat: "Chat" = await Chat.create(self, name=name, description=description, image_url=image_url)
+        except RelayPublishError as e:
+            return RoflStatus.ERROR.create(f"Chat {name} wasn't accepted by the relay: {e}")
         await self.join_chat(chat.uuid)
         return RoflStatus.SUCCESS.create(f"Created new chat {chat.uuid} successfully!!!")
 
+def get_user_cache_stats() -> dict:
+    return {
+        "size": len(_user_cache),
+        "max_size": _user_cache.maxsize,
+        "hits": _cache_hits,
+        "misses": _cache_misses
+    }
+
+@timed("get_user")
 async def get_user(uuid: str) -> Optional["User"]:
-    """Retrieves a user from MongoDB and returns a full User instance."""
+    """Retrieves a user from the cache, or else from MongoDB, and returns a full User instance."""
+    global _cache_hits, _cache_misses
+    user = _user_cache.get(uuid)
+    if user is not None:
+        _cache_hits += 1
+        return user
+    _cache_misses += 1
+
+    version = _version(uuid)
     db = await get_database()
     user_data = await db.users.find_one({"uuid": uuid})
     if not user_data:
         return None
 
     user_db = UserDB(**user_data)
-    return _user_db_to_user(user_db)
+    user = _user_db_to_user(user_db)
+    if _version(uuid) == version:
+        _user_cache[uuid] = user
+    return user
+
+@timed("get_users")
+async def get_users(uuids: list[str]) -> dict[str, "User"]:
+    """Retrieves many users at once, the ones that aren't cached with a single MongoDB query."""
+    global _cache_hits, _cache_misses
+    users = {}
+    missing = []
+    for uuid in set(uuids):
+        user = _user_cache.get(uuid)
+        if user is not None:
+            _cache_hits += 1
+            users[uuid] = user
+        else:
+            _cache_misses += 1
+            missing.append(uuid)
+
+    if missing:
+        versions = {uuid: _version(uuid) for uuid in missing}
+        db = await get_database()
+        async for user_data in db.users.find({"uuid": {"$in": missing}}):
+            user = _user_db_to_user(UserDB(**user_data))
+            if _version(user.uuid) == versions[user.uuid]:
+                _user_cache[user.uuid] = user
+            users[user.uuid] = user
+    return users
+
+async def send_message_batch(items: list[tuple[str, str, str]]) -> "RoflStatus":
+    """Sends many (user id, chat id, message) items, resolving every user and chat only once.
+    The value is the result of each item, in the order they were given."""
+    if len(items) > MESSAGE_BATCH_MAX:
+        return RoflStatus.ERROR.create(f"A batch can hold at most {MESSAGE_BATCH_MAX} messages")
+
+    users = await get_users([user_id for user_id, _, _ in items])
+    chats = await get_existing_chats([chat_id for _, chat_id, _ in items])
+
+    results = []
+    to_sign = []
+    for user_id, chat_id, message in items:
+        user = users.get(user_id)
+        if user is None:
+            results.append(RoflStatus.ERROR.create(f"User {user_id} not found"))
+        elif chat_id not in chats:
+            results.append(RoflStatus.ERROR.create(f"Chat {chat_id} not found"))
+        elif chat_id not in user.joined_chats:
+            results.append(RoflStatus.ERROR.create(f"User {user_id} is not in this group {chat_id}"))
+        else:
+            to_sign.append((message_event(user, chat_id, message), user.private_key_hex))
+            # the message is filled in from its event once it is signed
+            results.append(RoflStatus.SUCCESS.create(f"Managed to send the new message from {user_id}"))
+
+    # signed in batches off the event loop, then pipelined over the pool within its publish window
+    relay = await get_relay()
+    signed = await sign_events(to_sign)
+    # the same message from the same user in the same second is the same event, it is only sent once
+    first: dict[str, int] = {}
+    for pos, evt in enumerate(signed):
+        first.setdefault(evt.id, pos)
+    unique = list(first.values())
+    published = await asyncio.gather(*[relay.publish(signed[pos]) for pos in unique], return_exceptions=True)
+    outcome = dict(zip(unique, published))
+
+    sent: Counter = Counter()
+    pos = 0
+    # position of an event in signed -> index of the item it was sent for
+    item_of: dict[int, int] = {}
+    for i, result in enumerate(results):
+        if isinstance(result, Error):
+            continue
+        user_id, chat_id, _ = items[i]
+        evt = signed[pos]
+        item_of[pos] = i
+        if first[evt.id] != pos:
+            results[i] = RoflStatus.ERROR.create(
+                f"Duplicate of item {item_of[first[evt.id]]}, the same message was already sent in this batch")
+        elif isinstance(outcome[pos], Exception):
+            results[i] = RoflStatus.ERROR.create(f"Message from {user_id} wasn't accepted by the relay: {outcome[pos]}")
+        else:
+            result.value = Message.from_event(evt, chat_id, sender=user_id)
+            sent[chat_id] += 1
+        pos += 1
+
+    await add_message_counts(sent)
+    return RoflStatus.SUCCESS.create(f"Sent {sum(sent.values())} of {len(items)} messages", results)
+
+async def backfill_memberships() -> "RoflStatus":
+    """Publishes a join event for every chat in a user's joined_chats that has no join/leave event of that user.
+    Chats are counting members from these events, users who joined before they were published would be missing.
+    Safe to run again, users who already have an event in a chat are skipped."""
+    view = get_chat_view()
+    if view is None or not view.ready.is_set():
+        return RoflStatus.ERROR.create("The chat view isn't loaded yet, try again")
+
+    relay = await get_relay()
+    published = 0
+    failed = 0
+    to_sign = []
+
+    async def flush():
+        nonlocal published, failed
+        signed = await sign_events(to_sign)
+        to_sign.clear()
+        results = await asyncio.gather(*[relay.publish(evt) for evt in signed], return_exceptions=True)
+        for evt, result in zip(signed, results):
+            if isinstance(result, Exception):
+                failed += 1
+            else:
+                published += 1
+                view.apply(evt)
+
+    db = await get_database()
+    async for user_data in db.users.find({"joined_chats": {"$ne": []}}):
+        user = _user_db_to_user(UserDB(**user_data))
+        for chat_id in user.joined_chats:
+            state = view.get(chat_id)
+            if state is not None and not state.membership_at(user.public_key_hex):
+                to_sign.append((membership_event(user, chat_id, KIND_CHANNEL_JOIN), user.private_key_hex))
+        # signed and published a batch at a time, however many users there are
+        if len(to_sign) >= MESSAGE_BATCH_MAX:
+            await flush()
+    await flush()
+    return RoflStatus.SUCCESS.create(f"Published {published} join events, {failed} weren't accepted by the relay")
 
 def _user_db_to_user(user_db: UserDB) -> "User":
     """Converts a UserDB instance to a full User instance."""
-    # Create a new User instance
-    user = User(user_db.display_name, user_db.uuid)
-
-    # Set up the nostr keys
-    user.nostr_key = Keys(user_db.nostr_private_key)
+    # Create a new User instance, the stored keys are used as they are
+    user = User(user_db.display_name, user_db.uuid,
+                private_key_hex=user_db.nostr_private_key,
+                public_key_hex=user_db.nostr_public_key)
 
-    # Set the joined chats
+    # Set the joined chats and how far each one has been read
     user.joined_chats = user_db.joined_chats.copy()
+    user.read_cursors = user_db.read_cursors.copy()
 
     return user
 
+@timed("save_user")
 async def save_user(user: "User") -> None:
     """Saves the current state of a User instance back to MongoDB."""
     user_db = UserDB(
         display_name=user.display_name,
         uuid=user.uuid,
-        nostr_public_key=user.nostr_key.public_key_hex(),
-        nostr_private_key=user.nostr_key.private_key_hex(),
-        joined_chats=user.joined_chats.copy()
+        nostr_public_key=user.public_key_hex,
+        nostr_private_key=user.private_key_hex,
+        joined_chats=user.joined_chats.copy(),
+        read_cursors=user.read_cursors.copy()
     )
 
     db = await get_database()
@@ -111,4 +357,51 @@ async def save_user(user: "User") -> None:
         {"uuid": user.uuid},
         {"$set": user_db.dict()},
         upsert=True
-    )
\ No newline at end of file
+    )
+    # write through, the next get_user is served from memory
+    _changed([user.uuid])
+    _user_cache[user.uuid] = user
+    await invalidate("user", [user.uuid])
+
+@timed("add_joined_chat")
+async def add_joined_chat(uuid: str, chat_id: str) -> bool:
+    """Adds a chat to the user's joined_chats in one atomic update.
+    Returns False if the user was already in the chat."""
+    db = await get_database()
+    result = await db.users.update_one(
+        {"uuid": uuid, "joined_chats": {"$ne": chat_id}},
+        {"$addToSet": {"joined_chats": chat_id}}
+    )
+    if result.modified_count != 1:
+        return False
+    await invalidate("user", [uuid])
+    return True
+
+@timed("remove_joined_chat")
+async def remove_joined_chat(uuid: str, chat_id: str) -> bool:
+    """Removes a chat from the user's joined_chats in one atomic update.
+    Returns False if the user wasn't in the chat."""
+    db = await get_database()
+    result = await db.users.update_one(
+        {"uuid": uuid, "joined_chats": chat_id},
+        # the read cursor goes with it, the document only keeps cursors of joined chats
+        {"$pull": {"joined_chats": chat_id}, "$unset": {f"read_cursors.{chat_id}": ""}}
+    )
+    if result.modified_count != 1:
+        return False
+    await invalidate("user", [uuid])
+    return True
+
+@timed("set_read_cursor")
+async def set_read_cursor(uuid: str, chat_id: str, seq: int) -> bool:
+    """Moves a read cursor forward in one atomic update ($max), concurrent updates can't move it back.
+    Returns False if it already was at or past seq."""
+    db = await get_database()
+    result = await db.users.update_one(
+        {"uuid": uuid},
+        {"$max": {f"read_cursors.{chat_id}": seq}}
+    )
+    if result.modified_count != 1:
+        return False
+    await invalidate("user", [uuid])
+    return True